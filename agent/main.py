@@ -1,24 +1,58 @@
+import asyncio
+import codecs
+import functools
+import hashlib
+import io
+import json
+import locale
 import logging
+import math
 import os
 import platform
+import queue
+import random
 import re
 import shlex
+import shutil
+import signal
 import socket
-import tempfile
+import subprocess
 import threading
 import time
-from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, InvalidStateError, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
 from subprocess import PIPE, STDOUT, Popen
-from typing import Any, Dict, Optional, Sequence
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence
+from urllib.parse import urlparse
 
 from dotenv import load_dotenv
 from supabase import Client, create_client
 
+try:
+    import cv2  # type: ignore
+except Exception:  # optional: enables confidence-based template matching
+    cv2 = None
+
+try:
+    import mss  # type: ignore
+except Exception:  # optional: faster screen grabs than pyautogui/PIL ImageGrab
+    mss = None
+
+try:
+    import orjson  # type: ignore
+except Exception:  # optional: faster JSON for the poll/claim/upsert requests
+    orjson = None
+
 
 # Prefer agent/.env values over inherited environment variables.
 # This avoids cases where an empty/old env var blocks the intended .env config.
-_DOTENV_PATH = (Path(__file__).resolve().parent / ".env").resolve()
+_AGENT_DIR = Path(__file__).resolve().parent
+_DOTENV_PATH = (_AGENT_DIR / ".env").resolve()
+# Written while running so integration/stop_agent.ps1 can find us: the venv's python.exe is a
+# launcher, so the real interpreter's command line doesn't name this checkout.
+_PID_PATH = _AGENT_DIR / "agent.pid"
 load_dotenv(dotenv_path=_DOTENV_PATH, override=True)
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -27,16 +61,34 @@ COMMAND_TIMEOUT_SEC = int(os.getenv("COMMAND_TIMEOUT_SEC", "120"))
 LOG_FLUSH_INTERVAL_SEC = float(os.getenv("LOG_FLUSH_INTERVAL_SEC", "1.5"))
 LOG_MAX_CHARS = int(os.getenv("LOG_MAX_CHARS", "20000"))
 AGENT_USER_ID = os.getenv("AGENT_USER_ID")
+AGENT_LOCK_NAME = os.getenv("AGENT_LOCK_NAME", "ServerVibeAgent").strip() or "ServerVibeAgent"
+# Recorded as claimed_by on claimed rows; orphan recovery after a restart only fails this agent's rows.
+# One agent per lock name per host (single-instance guard), so host + lock name is stable and unique.
+AGENT_ID = os.getenv("AGENT_ID", "").strip() or f"{socket.gethostname()}/{AGENT_LOCK_NAME}"
 POLL_INTERVAL_SEC = float(os.getenv("POLL_INTERVAL_SEC", "1.0"))
 POLL_MAX_BATCH = int(os.getenv("POLL_MAX_BATCH", "20"))
+# Empty polls back off exponentially from POLL_INTERVAL_SEC up to this cap.
+POLL_MAX_SLEEP_SEC = float(os.getenv("POLL_MAX_SLEEP_SEC", "5"))
+# Max commands running at once. Different users run in parallel; each user's commands,
+# and all GUI commands, still run one at a time in order.
+AGENT_WORKERS = max(1, int(os.getenv("AGENT_WORKERS", "8")))
+# Realtime (postgres_changes over WebSocket) delivers new commands immediately; while it is
+# subscribed the REST poll only runs every POLL_WATCHDOG_SEC to catch missed events.
+REALTIME_ENABLED = os.getenv("REALTIME_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off")
+POLL_WATCHDOG_SEC = float(os.getenv("POLL_WATCHDOG_SEC", "30"))
+# Optional direct Postgres URL: LISTEN commands_new wakes the poller on every insert
+# (needs psycopg 3.2+ and the notify trigger from supabase_step1.sql).
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL", "").strip()
 
 # IDE chat (GUI automation) settings.
 # - IDE_WINDOW_TITLE_SUBSTR: window title substring to activate (e.g. "Visual Studio Code", "Cursor", "Antigravity")
 # - IDE_INPUT_POS / IDE_OUTPUT_POS: click targets like "960,980" (x,y) for input box and transcript/log area
 # - IDE_CHAT_FOCUS_HOTKEY: optional keys like "ctrl+l" to focus chat input (leave empty to skip)
-# - IDE_RESPONSE_WAIT_SEC: fixed wait for MVP (default 15s)
+# - IDE_RESPONSE_WAIT_SEC: max wait for an answer (default 15s)
+# - IDE_RESPONSE_POLL_SEC: re-copy the transcript this often; stop once the answer is stable (0 = single copy after the wait)
+# - IDE_RESPONSE_MIN_WAIT_SEC / IDE_RESPONSE_STABLE_SEC: never stop before the minimum wait, and only
+#   once the marked answer after our question has stayed unchanged this long
 # - AI_ANSWER_MARKERS: comma-separated markers for extracting the last assistant answer from copied transcript
-IDE_TARGET = os.getenv("IDE_TARGET", "vscode").strip().lower()
 IDE_WINDOW_TITLE_SUBSTR = os.getenv("IDE_WINDOW_TITLE_SUBSTR", "").strip()
 IDE_INPUT_POS = os.getenv("IDE_INPUT_POS", "").strip()
 IDE_OUTPUT_POS = os.getenv("IDE_OUTPUT_POS", "").strip()
@@ -53,9 +105,16 @@ IDE_IMAGE_CONFIDENCE = float(os.getenv("IDE_IMAGE_CONFIDENCE", "0.85"))
 IDE_LEARN_TEMPLATE_W = int(os.getenv("IDE_LEARN_TEMPLATE_W", "320"))
 IDE_LEARN_TEMPLATE_H = int(os.getenv("IDE_LEARN_TEMPLATE_H", "160"))
 IDE_LEARN_COUNTDOWN_SEC = float(os.getenv("IDE_LEARN_COUNTDOWN_SEC", "5"))
+# /ide learn debug preview: the region plus a margin by default, or the whole screen when set.
+IDE_LEARN_DEBUG_FULLSCREEN = os.getenv("IDE_LEARN_DEBUG_FULLSCREEN", "0").strip().lower() in ("1", "true", "yes", "on")
 IDE_RESPONSE_WAIT_SEC = float(os.getenv("IDE_RESPONSE_WAIT_SEC", "15"))
+IDE_RESPONSE_POLL_SEC = float(os.getenv("IDE_RESPONSE_POLL_SEC", "1.5"))
+IDE_RESPONSE_MIN_WAIT_SEC = float(os.getenv("IDE_RESPONSE_MIN_WAIT_SEC", "4"))
+IDE_RESPONSE_STABLE_SEC = float(os.getenv("IDE_RESPONSE_STABLE_SEC", "3"))
 IDE_SEND_RETRY_COUNT = int(os.getenv("IDE_SEND_RETRY_COUNT", "1"))
 IDE_RETRY_WAIT_SEC = float(os.getenv("IDE_RETRY_WAIT_SEC", "4"))
+# pyautogui.PAUSE: delay after every pyautogui call (pyautogui's own default is 0.1s).
+IDE_ACTION_PAUSE_SEC = float(os.getenv("IDE_ACTION_PAUSE_SEC", "0"))
 # Submit key strategy (comma-separated): enter,ctrl+enter,alt+enter
 IDE_SUBMIT_KEYS = os.getenv("IDE_SUBMIT_KEYS", "enter,ctrl+enter").strip()
 AI_ANSWER_MARKERS = os.getenv(
@@ -92,9 +151,44 @@ def _acquire_single_instance_guard() -> None:
     """
     Prevent accidental double-runs.
 
-    We use a localhost TCP bind as a robust cross-platform singleton guard.
-    File locks can be flaky across shells/launchers on Windows.
+    - Windows: a named kernel mutex (no port, no firewall prompt).
+    - Linux: an abstract UNIX socket (no filesystem entry, released by the kernel on exit).
+    - Elsewhere: a localhost TCP bind on AGENT_LOCK_PORT.
+    File locks can be flaky across shells/launchers on Windows, so we avoid them.
     """
+    lock_name = AGENT_LOCK_NAME
+    already_running = RuntimeError(
+        "Another Server Vibe agent instance is already running "
+        f"(lock {lock_name!r} is held). Stop the existing one (Ctrl+C) and try again."
+    )
+
+    system = platform.system().lower()
+    if system == "windows":
+        import ctypes
+        from ctypes import wintypes
+
+        ERROR_ALREADY_EXISTS = 183
+        # use_last_error: ctypes saves GetLastError right after the call; a later
+        # kernel32.GetLastError() may see a value overwritten by the interpreter.
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        kernel32.CreateMutexW.argtypes = [wintypes.LPVOID, wintypes.BOOL, wintypes.LPCWSTR]
+        kernel32.CreateMutexW.restype = wintypes.HANDLE
+        handle = kernel32.CreateMutexW(None, True, f"Global\\{lock_name}")
+        if not handle or ctypes.get_last_error() == ERROR_ALREADY_EXISTS:
+            raise already_running
+        # Keep the handle alive for the process lifetime.
+        globals()["_SINGLE_INSTANCE_GUARD_HANDLE"] = handle
+        return
+
+    if system == "linux":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(f"\0{lock_name}")
+        except OSError:
+            raise already_running
+        globals()["_SINGLE_INSTANCE_GUARD_SOCKET"] = sock
+        return
+
     lock_port = int(os.getenv("AGENT_LOCK_PORT", "45321"))
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -111,10 +205,110 @@ def _acquire_single_instance_guard() -> None:
     globals()["_SINGLE_INSTANCE_GUARD_SOCKET"] = sock
 
 
-_acquire_single_instance_guard()
+
+def _http2_available() -> bool:
+    try:
+        import h2  # type: ignore  # noqa: F401
+
+        return True
+    except ImportError:
+        return False
+
+
+def _http_limits() -> Any:
+    import httpx
+
+    return httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60.0)
+
+
+def _shared_http_client() -> Any:
+    """
+    One keep-alive httpx client for PostgREST + Storage (HTTP/2 when `h2` is installed),
+    so polls, status updates and uploads multiplex over a single TLS session.
+    """
+    import httpx
+
+    return httpx.Client(
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        http2=_http2_available(),
+        limits=_http_limits(),
+        follow_redirects=True,
+    )
 
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+def _pooled_http_client(template: Any) -> Any:
+    """
+    Build a keep-alive httpx client that mirrors the base_url/headers/timeout of `template`.
+    """
+    import httpx
+
+    return httpx.Client(
+        base_url=template.base_url,
+        headers=template.headers,
+        timeout=template.timeout,
+        http2=_http2_available(),
+        limits=_http_limits(),
+        follow_redirects=True,
+    )
+
+
+def _install_pooled_http_clients(client: Client) -> None:
+    """
+    Best-effort: swap the PostgREST and Storage sessions for pooled keep-alive clients,
+    so frequent log flushes/uploads reuse TLS connections instead of renegotiating.
+    """
+    try:
+        pg = client.postgrest
+        old = pg.session
+        pg.session = _pooled_http_client(old)
+        old.close()
+    except Exception as e:
+        logger.debug("PostgREST session swap skipped: %s", e)
+
+    try:
+        st = client.storage
+        old = getattr(st, "_client", None) or st.session
+        pooled = _pooled_http_client(old)
+        st.session = pooled
+        st._client = pooled
+        old.close()
+    except Exception as e:
+        logger.debug("Storage session swap skipped: %s", e)
+
+
+def _create_supabase_client() -> Client:
+    try:
+        from supabase import ClientOptions
+
+        options = ClientOptions(httpx_client=_shared_http_client())
+    except (ImportError, TypeError):
+        # Older supabase-py has no httpx_client option: swap the sessions after creation.
+        client = create_client(SUPABASE_URL, SUPABASE_KEY)
+        _install_pooled_http_clients(client)
+        return client
+    return create_client(SUPABASE_URL, SUPABASE_KEY, options=options)
+
+
+_SUPABASE: Optional[Client] = None
+_SUPABASE_LOCK = threading.Lock()
+
+
+def _supabase_client() -> Client:
+    """
+    The shared Supabase client, created on first use so importing this module stays cheap.
+    """
+    global _SUPABASE
+    if _SUPABASE is None:
+        with _SUPABASE_LOCK:
+            if _SUPABASE is None:
+                _SUPABASE = _create_supabase_client()
+    return _SUPABASE
+
+# Hosted Supabase public URLs are a pure function of bucket + object path, so we can
+# build them locally instead of asking the Storage API after every upload.
+_PUBLIC_URL_BASE: Optional[str] = None
+if (urlparse(SUPABASE_URL).hostname or "").endswith(".supabase.co"):
+    _PUBLIC_URL_BASE = f"{SUPABASE_URL.rstrip('/')}/storage/v1/object/public/screenshots/"
 
 
 APP_COMMANDS_WINDOWS = {
@@ -127,11 +321,14 @@ APP_COMMANDS_WINDOWS = {
 }
 
 
+_TRUNCATED_PREFIX = "[log truncated]\n"
+
+
 def _truncate_log(log_text: str) -> str:
     if len(log_text) <= LOG_MAX_CHARS:
         return log_text
     tail = log_text[-LOG_MAX_CHARS:]
-    return "[log truncated]\n" + tail
+    return _TRUNCATED_PREFIX + tail
 
 
 def update_command(
@@ -146,34 +343,416 @@ def update_command(
     if image_url is not None:
         payload["image_url"] = image_url
 
-    supabase.table("commands").update(payload).eq("id", command_id).execute()
+    current = getattr(_CURRENT_COMMAND, "row", None)
+    batch = getattr(_CURRENT_COMMAND, "batch", None)
+    if status in _TERMINAL_STATUSES and batch is not None and current and current["id"] == command_id:
+        full: Optional[list[Dict[str, Any]]] = None
+        with _BATCH_LOCK:
+            # Only commands dispatched by the still-open poll batch defer their final
+            # status (see _batched_updates); realtime or late rows update right away.
+            buffered = batch is _ACTIVE_BATCH
+            if buffered:
+                if not batch:
+                    # First row since the last flush: write it (and whatever joins it) shortly.
+                    timer = threading.Timer(_BATCH_FLUSH_DELAY_SEC, _flush_batch, args=(batch,))
+                    timer.daemon = True
+                    timer.start()
+                batch.append({**current, **payload})
+                if len(batch) >= POLL_MAX_BATCH:
+                    full = batch[:]
+                    batch.clear()
+        if buffered:
+            if full:
+                _flush_updates(full)
+            return
 
+    # return=minimal: the agent never reads the updated row back, so don't ship it over the wire.
+    _supabase_client().table("commands").update(payload, returning="minimal").eq("id", command_id).execute()
 
-def capture_screen(user_id: str) -> Dict[str, Optional[str]]:
-    import pyautogui
 
-    now = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    object_path = f"{user_id}/{now}.png"
+_TERMINAL_STATUSES = frozenset(("completed", "error"))
+# Row identity (.row) and dispatching poll batch (.batch) of the command being handled
+# on this thread (set by handle_command).
+_CURRENT_COMMAND = threading.local()
+# Buffer of the poll batch in flight; commands whose .batch is this list append to it.
+_ACTIVE_BATCH: Optional[list[Dict[str, Any]]] = None
+_BATCH_LOCK = threading.Lock()
+# A buffered final status waits at most this long for others to share its upsert; a slow
+# command in the same batch never holds back the fast ones' results.
+_BATCH_FLUSH_DELAY_SEC = 0.2
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        local_path = Path(tmpdir) / "capture.png"
-        screenshot = pyautogui.screenshot()
-        screenshot.save(local_path)
 
-        with open(local_path, "rb") as f:
-            supabase.storage.from_("screenshots").upload(
-                object_path,
-                f,
-                {"content-type": "image/png", "upsert": "true"},
-            )
+def _flush_batch(batch: list[Dict[str, Any]]) -> None:
+    with _BATCH_LOCK:
+        rows = batch[:]
+        batch.clear()
+    _flush_updates(rows)
 
-    public_url_result = supabase.storage.from_("screenshots").get_public_url(object_path)
-    if isinstance(public_url_result, dict):
-        image_url = public_url_result.get("publicURL") or public_url_result.get("publicUrl")
+
+def _flush_updates(rows: list[Dict[str, Any]]) -> None:
+    """
+    Write buffered terminal updates with one upsert per column set.
+
+    Rows carry user_id/command_text so the upsert's INSERT half satisfies NOT NULL; columns a
+    caller didn't pass are left out (not nulled) by grouping rows on their key set.
+    """
+    if not rows:
+        return
+    groups: Dict[tuple, list[Dict[str, Any]]] = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for group in groups.values():
+        try:
+            _rest_request("POST", _UPSERT_URL, group, _UPSERT_HEADERS)
+        except Exception as e:
+            logger.warning("Batched status upsert failed (%s); updating rows one by one", e)
+            for row in group:
+                try:
+                    payload = {k: v for k, v in row.items() if k not in ("id", "user_id", "command_text")}
+                    _supabase_client().table("commands").update(payload, returning="minimal").eq("id", row["id"]).execute()
+                except Exception:
+                    logger.exception("Failed to update command %s", row["id"])
+
+
+@contextmanager
+def _batched_updates() -> Iterator[list[Dict[str, Any]]]:
+    """
+    Coalesce terminal status updates of the commands dispatched with the yielded batch: rows are
+    flushed _BATCH_FLUSH_DELAY_SEC after the first one is buffered, and any leftovers on exit.
+    """
+    global _ACTIVE_BATCH
+    rows: list[Dict[str, Any]] = []
+    with _BATCH_LOCK:
+        _ACTIVE_BATCH = rows
+    try:
+        yield rows
+    finally:
+        with _BATCH_LOCK:
+            _ACTIVE_BATCH = None
+            leftover = rows[:]
+        _flush_updates(leftover)
+
+
+class _FifoLock:
+    """
+    Mutex granted in request order (threading.Lock wakes waiters in arbitrary order).
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+
+    def __enter__(self) -> None:
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving:
+                self._cond.wait()
+
+    def __exit__(self, *exc: Any) -> None:
+        with self._cond:
+            self._serving += 1
+            self._cond.notify_all()
+
+
+# Serializes commands that drive the mouse/keyboard/screen, first come first served.
+_GUI_LOCK = _FifoLock()
+# Command ids queued or running, so a row seen by both realtime and the poll is submitted once.
+_INFLIGHT: set = set()
+_INFLIGHT_LOCK = threading.Lock()
+# Per-user FIFO of (cmd, claimed, batch, future). A user's commands run one at a time in submit
+# (created_at) order on that user's lane thread; lanes of different users run in parallel.
+_LANES: Dict[str, "deque[tuple]"] = {}
+_LANES_LOCK = threading.Lock()
+_WORKER_SLOTS = threading.BoundedSemaphore(AGENT_WORKERS)
+
+
+def _submit_command(
+    cmd: tuple[str, str, str],
+    claimed: bool = False,
+    batch: Optional[list[Dict[str, Any]]] = None,
+) -> Optional[Future]:
+    command_id, user_id = cmd[0], cmd[1]
+    with _INFLIGHT_LOCK:
+        if command_id in _INFLIGHT:
+            return None
+        _INFLIGHT.add(command_id)
+
+    future: Future = Future()
+    with _LANES_LOCK:
+        lane = _LANES.get(user_id)
+        idle = lane is None
+        if idle:
+            lane = _LANES[user_id] = deque()
+        lane.append((cmd, claimed, batch, future))
+    if idle:
+        # Daemon: shutdown never waits for a running /sh or chat command (see _release_queued_commands).
+        threading.Thread(target=_run_lane, args=(user_id,), name=f"cmd-{user_id[:8]}", daemon=True).start()
+    return future
+
+
+def _run_lane(user_id: str) -> None:
+    while True:
+        with _WORKER_SLOTS:
+            with _LANES_LOCK:
+                lane = _LANES.get(user_id)
+                if lane is None or _STOP.is_set():
+                    return
+                if not lane:
+                    del _LANES[user_id]
+                    return
+                cmd, claimed, batch, future = lane.popleft()
+            try:
+                handle_command(*cmd, claimed, batch)
+            except Exception:
+                logger.exception("Command %s crashed", cmd[0])
+            finally:
+                with _INFLIGHT_LOCK:
+                    _INFLIGHT.discard(cmd[0])
+                future.set_result(None)
+
+
+def _release_queued_commands() -> None:
+    """
+    On shutdown, put claimed rows that never started back to "pending" for the next run,
+    instead of leaving them "processing" for the orphan sweep to fail.
+    """
+    with _LANES_LOCK:
+        queued = [entry for lane in _LANES.values() for entry in lane]
+        _LANES.clear()
+    for cmd, claimed, _, _ in queued:
+        if not claimed:
+            continue
+        try:
+            update_command(cmd[0], "pending")
+        except Exception as e:
+            logger.warning("Could not release queued command %s: %s", cmd[0], e)
+    if queued:
+        logger.info("Released %d queued command(s) on shutdown", len(queued))
+
+
+def _dispatch_rows(
+    rows: list[Dict[str, Any]],
+    timeout_sec: Optional[float] = None,
+    claimed: bool = False,
+    batch: Optional[list[Dict[str, Any]]] = None,
+) -> tuple[int, set]:
+    """
+    Queue rows on their users' lanes and wait for them (or shutdown).
+
+    Returns (number of commands newly submitted, futures still running); rows already in flight
+    (e.g. pushed by realtime) are not resubmitted and don't count.
+    """
+    cmds = [cmd for cmd in (_unpack_row(row, claimed) for row in rows) if cmd]
+    pending = {f for f in (_submit_command(cmd, claimed, batch) for cmd in cmds) if f is not None}
+    submitted = len(pending)
+    deadline = None if timeout_sec is None else time.monotonic() + timeout_sec
+    while pending and not _STOP.is_set():
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            break
+        _, pending = wait(pending | {_STOP_FUTURE}, timeout=remaining, return_when=FIRST_COMPLETED)
+        pending.discard(_STOP_FUTURE)
+    return submitted, pending
+
+
+_PYAUTOGUI: Any = None
+_PYGETWINDOW: Any = None
+_GUI_IMPORT_LOCK = threading.Lock()
+
+
+def _pyautogui() -> Any:
+    """
+    Import pyautogui once, configure it, and keep a module-level reference.
+
+    The first pyautogui import probes the display (~100 ms); `_prewarm_gui_modules` pays
+    that at startup so the first GUI command doesn't.
+    """
+    global _PYAUTOGUI
+    if _PYAUTOGUI is None:
+        with _GUI_IMPORT_LOCK:
+            if _PYAUTOGUI is None:
+                import pyautogui
+
+                # pyautogui sleeps PAUSE (0.1s) after every call; the chat flow already sleeps
+                # explicitly where the IDE needs time, so the default only adds latency.
+                pyautogui.PAUSE = IDE_ACTION_PAUSE_SEC
+                _PYAUTOGUI = pyautogui
+    return _PYAUTOGUI
+
+
+def _gui_modules() -> tuple[Any, Any]:
+    """
+    pyautogui + pygetwindow, imported once (pygetwindow only supports Windows/macOS).
+    """
+    global _PYGETWINDOW
+    pyautogui = _pyautogui()
+    if _PYGETWINDOW is None:
+        import pygetwindow
+
+        _PYGETWINDOW = pygetwindow
+    return pyautogui, _PYGETWINDOW
+
+
+def _prewarm_gui_modules() -> None:
+    if not _IS_WINDOWS:
+        # GUI commands are Windows-only; importing pyautogui without a display can fail.
+        return
+
+    def _warm() -> None:
+        try:
+            _gui_modules()
+        except Exception as e:
+            logger.debug("GUI module prewarm failed: %s", e)
+        # Decode the image templates here rather than at import, so importing stays cheap.
+        _preload_templates()
+
+    threading.Thread(target=_warm, name="gui-prewarm", daemon=True).start()
+
+
+_MSS_LOCAL = threading.local()
+
+
+def _mss_handle() -> Any:
+    # mss handles are bound to the creating thread on Windows, so keep one per thread.
+    sct = getattr(_MSS_LOCAL, "sct", None)
+    if sct is None:
+        sct = mss.mss()
+        _MSS_LOCAL.sct = sct
+    return sct
+
+
+def _mss_primary_grab() -> Any:
+    """
+    Grab the primary monitor via mss (BGRA buffer, no PIL copy).
+    """
+    sct = _mss_handle()
+    # Same origin as pyautogui: the monitor at (0,0), so match coordinates stay clickable.
+    monitor = next(
+        (m for m in sct.monitors[1:] if m["left"] == 0 and m["top"] == 0),
+        sct.monitors[1],
+    )
+    return sct.grab(monitor)
+
+
+def _grab_screen() -> Any:
+    """Primary-monitor screenshot as a PIL RGB image (mss when available)."""
+    if mss is None:
+        return _pyautogui().screenshot()
+
+    from PIL import Image
+
+    raw = _mss_primary_grab()
+    return Image.frombytes("RGB", raw.size, raw.bgra, "raw", "BGRX")
+
+
+def _grab_region(left: int, top: int, width: int, height: int) -> Any:
+    """Screenshot of one screen rectangle as a PIL RGB image; mss copies only that bbox."""
+    if mss is None:
+        return _pyautogui().screenshot(region=(left, top, width, height))
+
+    from PIL import Image
+
+    raw = _mss_handle().grab({"left": left, "top": top, "width": width, "height": height})
+    return Image.frombytes("RGB", raw.size, raw.bgra, "raw", "BGRX")
+
+
+def _grab_screen_gray() -> Any:
+    """Primary-monitor screenshot as a grayscale ndarray for cv2 matching."""
+    import numpy as np
+
+    if mss is None:
+        return cv2.cvtColor(np.asarray(_pyautogui().screenshot().convert("RGB")), cv2.COLOR_RGB2GRAY)
+    return cv2.cvtColor(np.asarray(_mss_primary_grab()), cv2.COLOR_BGRA2GRAY)
+
+
+def _utc_stamp() -> str:
+    # time.gmtime + strftime avoids building a datetime object per screenshot name.
+    return time.strftime("%Y%m%d_%H%M%S", time.gmtime())
+
+
+def _encode_png(img: Any, palette: bool = False) -> bytes:
+    """
+    Encode a PIL image to PNG bytes in memory (no temp file round-trip).
+
+    compress_level=1 keeps zlib cheap; screenshots of UI compress well even at low levels.
+    `palette=True` quantizes to 256 colors first (fast octree): several times smaller for
+    look-only debug images. Never use it for templates that get matched.
+    """
+    if palette:
+        img = img.quantize(colors=256, method=2)  # 2 = Image.Quantize.FASTOCTREE
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+def _upload_png(object_path: str, data: bytes) -> None:
+    _supabase_client().storage.from_("screenshots").upload(
+        object_path,
+        data,
+        {"content-type": "image/png", "upsert": "true"},
+    )
+
+
+# Uploads nobody waits on (e.g. /ide learn previews) run here so the command can finish first.
+_UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="upload")
+
+
+def _upload_png_with_retry(object_path: str, data: bytes, attempts: int = 3) -> None:
+    for attempt in range(attempts):
+        try:
+            _upload_png(object_path, data)
+            return
+        except Exception as e:
+            if attempt == attempts - 1:
+                logger.warning("Background upload of %s failed: %s", object_path, e)
+                return
+            time.sleep(0.5 * 2**attempt)
+
+
+def _upload_png_background(object_path: str, data: bytes) -> Future:
+    return _UPLOAD_EXECUTOR.submit(_upload_png_with_retry, object_path, data)
+
+
+def _upload_image_background(object_path: str, img: Any, palette: bool = False) -> Future:
+    """
+    Encode + upload on the upload pool. Pillow releases the GIL while zlib-compressing,
+    so the encode overlaps with the command thread instead of blocking it.
+    The caller must not touch `img` afterwards.
+    """
+    return _UPLOAD_EXECUTOR.submit(lambda: _upload_png_with_retry(object_path, _encode_png(img, palette)))
+
+
+# (user_id, sha256) -> object path of recent capture uploads, so an unchanged screen isn't uploaded again.
+_CAPTURE_UPLOADS: "OrderedDict[tuple[str, str], str]" = OrderedDict()
+_CAPTURE_UPLOADS_LOCK = threading.Lock()
+
+
+def upload_capture(user_id: str, data: bytes) -> Dict[str, Optional[str]]:
+    """
+    Upload capture PNG bytes. Identical bytes reuse the earlier object instead of a new PUT;
+    the digest suffix also keeps two captures within the same second from overwriting each other.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    key = (user_id, digest)
+    with _CAPTURE_UPLOADS_LOCK:
+        object_path = _CAPTURE_UPLOADS.get(key)
+        if object_path:
+            _CAPTURE_UPLOADS.move_to_end(key)
+    if object_path:
+        log = f"Screenshot unchanged, reusing: {object_path}"
     else:
-        image_url = str(public_url_result)
+        object_path = f"{user_id}/{_utc_stamp()}_{digest[:8]}.png"
+        _upload_png(object_path, data)
+        with _CAPTURE_UPLOADS_LOCK:
+            _CAPTURE_UPLOADS[key] = object_path
+            while len(_CAPTURE_UPLOADS) > 64:
+                _CAPTURE_UPLOADS.popitem(last=False)
+        log = f"Screenshot uploaded: {object_path}"
 
-    return {"log": f"Screenshot uploaded: {object_path}", "image_url": image_url}
+    image_url = _storage_public_url_from_upload(object_path)
+    return {"log": log, "image_url": image_url}
 
 
 def open_app(app_name: str) -> str:
@@ -189,28 +768,98 @@ def open_app(app_name: str) -> str:
     return f"Attempted to open: {app_name}"
 
 
+_IS_WINDOWS = platform.system().lower() == "windows"
+# Anything the shell would interpret (pipes, redirects, globbing, variables, ...) keeps shell=True.
+_SHELL_META_RE = re.compile(r"[&|<>^%!()\n]" if _IS_WINDOWS else r"[|&;<>()$`\\\"'*?\[\]#~{}\n]")
+
+
+def _shell_popen_args(command_text: str) -> tuple[Any, bool]:
+    """
+    Decide how to spawn a /sh command: (args, use_shell).
+
+    Plain "program arg arg" commands are exec'd directly, which skips one cmd.exe/sh process.
+    Shell builtins (dir, echo, cd, ...) and metacharacters still go through the shell.
+    """
+    if _SHELL_META_RE.search(command_text):
+        return command_text, True
+    try:
+        argv = shlex.split(command_text, posix=not _IS_WINDOWS)
+    except ValueError:
+        return command_text, True
+    resolved = shutil.which(argv[0].strip('"')) if argv else None
+    if not resolved:
+        return command_text, True
+    # which() also finds .cmd/.bat shims via PATHEXT (npm, yarn, code, ...), but CreateProcess
+    # only runs real executables; scripts need cmd.exe.
+    if _IS_WINDOWS and not resolved.lower().endswith((".exe", ".com")):
+        return command_text, True
+    # Windows: CreateProcess parses the command line itself, so pass the original string.
+    return (command_text if _IS_WINDOWS else argv), False
+
+
+# What text=True used to decode with: the ANSI code page on Windows (e.g. cp949), usually UTF-8 elsewhere.
+_CONSOLE_ENCODING = locale.getpreferredencoding(False) or "utf-8"
+
+
+def _decode_output(data: bytearray, truncated: bool = False) -> str:
+    """
+    Decode captured /sh output: UTF-8 when it is valid UTF-8, else the locale encoding.
+
+    A truncated tail may start mid-character and a partial snapshot may end mid-character;
+    neither counts against UTF-8 (leading continuation bytes are skipped, a trailing partial
+    character is held back).
+    """
+    start = 0
+    if truncated:
+        while start < min(3, len(data)) and 0x80 <= data[start] <= 0xBF:
+            start += 1
+    try:
+        return codecs.getincrementaldecoder("utf-8")().decode(data[start:] if start else data, final=False)
+    except UnicodeDecodeError:
+        return data.decode(_CONSOLE_ENCODING, "replace")
+
+
 def run_shell_command(command_id: str, command_text: str) -> str:
+    args, use_shell = _shell_popen_args(command_text)
     process = Popen(
-        command_text,
+        args,
         stdout=PIPE,
         stderr=STDOUT,
-        shell=True,
-        text=True,
-        bufsize=1,
+        shell=use_shell,
+        bufsize=0,
+        # No console window flash for console programs launched from the agent.
+        creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0) if _IS_WINDOWS else 0,
     )
 
-    buffer = []
-    last_flush = time.time()
-
-    def flush_partial(force: bool = False) -> None:
-        nonlocal last_flush
-        if not buffer:
-            return
-        if not force and (time.time() - last_flush) < LOG_FLUSH_INTERVAL_SEC:
-            return
-        partial = "".join(buffer)
-        update_command(command_id, "processing", response_log=partial)
-        last_flush = time.time()
+    # Only the last LOG_MAX_CHARS are ever reported, so keep a bounded byte tail
+    # instead of every line. Dropping from the front of a bytearray is O(1) amortized.
+    # The cap leaves room for the truncation prefix, so snapshots (prefix included) already
+    # fit and _truncate_log takes its no-copy fast path on every flush.
+    tail_cap = max(1, LOG_MAX_CHARS - len(_TRUNCATED_PREFIX))
+    tail = bytearray()
+    dropped = 0
+    buffer_lock = threading.Lock()
+    dirty = threading.Event()
+    finished = threading.Event()
+
+    def snapshot() -> str:
+        # Decode straight from the bytearray; the tail is capped, so holding the lock is brief.
+        with buffer_lock:
+            truncated = dropped > 0
+            text = _decode_output(tail, truncated)
+        return _TRUNCATED_PREFIX + text if truncated else text
+
+    def flusher() -> None:
+        # One partial-log UPDATE per interval at most, no matter how chatty the command is.
+        # The reader thread only appends + signals; network I/O never happens under the lock.
+        while not finished.wait(LOG_FLUSH_INTERVAL_SEC):
+            if not dirty.is_set():
+                continue
+            dirty.clear()
+            try:
+                update_command(command_id, "processing", response_log=snapshot())
+            except Exception as e:
+                logger.debug("Partial log flush failed: %s", e)
 
     def watchdog() -> None:
         try:
@@ -220,14 +869,30 @@ def run_shell_command(command_id: str, command_text: str) -> str:
 
     guard = threading.Thread(target=watchdog, daemon=True)
     guard.start()
+    flush_thread = threading.Thread(target=flusher, daemon=True)
+    flush_thread.start()
 
     assert process.stdout is not None
-    for line in process.stdout:
-        buffer.append(line)
-        flush_partial(force=False)
+    fd = process.stdout.fileno()
+    try:
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            with buffer_lock:
+                tail.extend(chunk)
+                overflow = len(tail) - tail_cap
+                if overflow > 0:
+                    del tail[:overflow]
+                    dropped += overflow
+            dirty.set()
+    finally:
+        finished.set()
+        flush_thread.join()
+        process.stdout.close()
 
     exit_code = process.wait()
-    final_log = "".join(buffer)
+    final_log = snapshot()
     if not final_log.strip():
         final_log = "(no output)"
 
@@ -267,16 +932,25 @@ def _parse_region(spec: str) -> Optional[tuple[int, int, int, int]]:
         return None
 
 
+@functools.lru_cache(maxsize=16)
 def _hotkey_from_spec(spec: str) -> Sequence[str]:
-    # Example: "ctrl+l" -> ["ctrl", "l"], "ctrl+shift+p" -> ["ctrl","shift","p"]
-    keys = [k.strip() for k in spec.split("+") if k.strip()]
-    return keys if keys else ["ctrl", "l"]
+    # Example: "ctrl+l" -> ("ctrl", "l"), "ctrl+shift+p" -> ("ctrl","shift","p")
+    keys = tuple(k.strip() for k in spec.split("+") if k.strip())
+    return keys if keys else ("ctrl", "l")
 
 
 def _submit_specs() -> list[str]:
     specs = [s.strip().lower() for s in IDE_SUBMIT_KEYS.split(",") if s.strip()]
     return specs or ["enter", "ctrl+enter"]
 
+
+# Click targets only change when .env is edited (calibration asks for a restart), so parse them once.
+_IDE_INPUT_XY = _parse_xy(IDE_INPUT_POS)
+_IDE_OUTPUT_XY = _parse_xy(IDE_OUTPUT_POS)
+_IDE_INPUT_REGION = _parse_region(IDE_INPUT_REGION)
+_IDE_OUTPUT_REGION = _parse_region(IDE_OUTPUT_REGION)
+_IDE_SUBMIT_SPECS = tuple(_submit_specs())
+
 def _resolve_asset_path(p: str) -> str:
     """
     Resolve relative paths (from agent folder) for image templates.
@@ -286,53 +960,566 @@ def _resolve_asset_path(p: str) -> str:
     pp = Path(p)
     if pp.is_absolute():
         return str(pp)
-    return str((Path(__file__).resolve().parent / pp).resolve())
+    return str((_AGENT_DIR / pp).resolve())
+
+
+# confidence= requires opencv; probe once instead of try/except-ing every locate attempt.
+_LOCATE_KWARGS: Dict[str, Any] = (
+    {"confidence": IDE_IMAGE_CONFIDENCE, "grayscale": True} if cv2 is not None else {"grayscale": True}
+)
+
+# Template matching is the expensive part of each locate attempt; poll a bit slower to amortize it.
+_LOCATE_POLL_SEC = 0.15
+
 
+# Coarse-to-fine search: match at 1/4 resolution (~16x less matchTemplate work), then confirm
+# the best candidate at full resolution inside a small window around it.
+_LOCATE_SCALE = 0.25
+_LOCATE_COARSE_SLACK = 0.05
+_LOCATE_REFINE_PAD = 8
+# Below this coarse size a template loses too much detail; match at full resolution instead.
+_LOCATE_MIN_COARSE_PX = 8
 
-def _click_by_image(pyautogui_mod: Any, image_path: str, timeout_sec: float) -> bool:
+
+@functools.lru_cache(maxsize=8)
+def _load_template_gray(path: str, scale: float = 1.0) -> Any:
+    """
+    Decode (and optionally downscale) a grayscale template once; later calls hit the cache.
+    Call `_load_template_gray.cache_clear()` after rewriting a template file.
+    """
+    import numpy as np
+
+    # imdecode(fromfile) instead of imread: imread can't open non-ASCII paths on Windows.
+    try:
+        raw = np.fromfile(path, dtype=np.uint8)
+    except FileNotFoundError:
+        raise RuntimeError(f"Image template not found: {path}")
+    tpl = cv2.imdecode(raw, cv2.IMREAD_GRAYSCALE)
+    if tpl is None:
+        raise RuntimeError(f"Failed to decode image template: {path}")
+    if scale != 1.0:
+        tpl = cv2.resize(tpl, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return tpl
+
+
+def _load_template_pyramid(path: str) -> tuple[Any, Any]:
+    """(full, coarse) grayscale templates; coarse is None when the template is too small to downscale."""
+    full = _load_template_gray(path)
+    coarse = _load_template_gray(path, _LOCATE_SCALE)
+    if min(coarse.shape[:2]) < _LOCATE_MIN_COARSE_PX:
+        coarse = None
+    return full, coarse
+
+
+def _best_match(image: Any, tpl: Any) -> tuple[float, tuple[int, int]]:
+    res = cv2.matchTemplate(image, tpl, cv2.TM_CCOEFF_NORMED)
+    _, max_val, _, max_loc = cv2.minMaxLoc(res)
+    return max_val, max_loc
+
+
+def _match_template_box(gray: Any, tpls: tuple[Any, Any]) -> Optional[tuple[int, int, int, int]]:
+    """
+    Match a template pyramid (see _load_template_pyramid) against a grayscale screen array.
+    Returns the full-resolution (left, top, width, height) of the match, or None below IDE_IMAGE_CONFIDENCE.
+    """
+    full, coarse = tpls
+    th, tw = full.shape[:2]
+    sh, sw = gray.shape[:2]
+    if sh < th or sw < tw:
+        return None
+
+    if coarse is None:
+        max_val, (x, y) = _best_match(gray, full)
+        return (x, y, tw, th) if max_val >= IDE_IMAGE_CONFIDENCE else None
+
+    small = cv2.resize(gray, None, fx=_LOCATE_SCALE, fy=_LOCATE_SCALE, interpolation=cv2.INTER_AREA)
+    ch, cw = coarse.shape[:2]
+    if small.shape[0] < ch or small.shape[1] < cw:
+        return None
+    max_val, (cx, cy) = _best_match(small, coarse)
+    if max_val < IDE_IMAGE_CONFIDENCE - _LOCATE_COARSE_SLACK:
+        return None
+
+    # Confirm at full resolution in a window around the coarse hit.
+    pad = _LOCATE_REFINE_PAD + int(1 / _LOCATE_SCALE)
+    x0 = max(0, int(cx / _LOCATE_SCALE) - pad)
+    y0 = max(0, int(cy / _LOCATE_SCALE) - pad)
+    x1 = min(sw, int(cx / _LOCATE_SCALE) + tw + pad)
+    y1 = min(sh, int(cy / _LOCATE_SCALE) + th + pad)
+    if y1 - y0 < th or x1 - x0 < tw:
+        return None
+    max_val, (x, y) = _best_match(gray[y0:y1, x0:x1], full)
+    if max_val < IDE_IMAGE_CONFIDENCE:
+        return None
+    return (x0 + x, y0 + y, tw, th)
+
+
+# Consecutive grabs are compared on a sparse pixel grid first; an identical grid means the
+# previous (failed) match would fail again, so matchTemplate is skipped while the screen is idle.
+_LOCATE_SIGNATURE_STEP = 8
+
+
+def _frame_signature(gray: Any) -> bytes:
+    return gray[::_LOCATE_SIGNATURE_STEP, ::_LOCATE_SIGNATURE_STEP].tobytes()
+
+
+def _match_template_center(gray: Any, tpls: tuple[Any, Any]) -> Optional[tuple[int, int]]:
+    """Full-resolution center of the best template match, or None."""
+    box = _match_template_box(gray, tpls)
+    if box is None:
+        return None
+    left, top, width, height = box
+    return (left + width // 2, top + height // 2)
+
+
+# Template paths are resolved once; with opencv the decoded templates are warmed up front too.
+_INPUT_TEMPLATE_PATH = _resolve_asset_path(IDE_INPUT_IMAGE)
+_OUTPUT_TEMPLATE_PATH = _resolve_asset_path(IDE_OUTPUT_IMAGE)
+
+
+def _preload_templates() -> None:
+    for env_name, path in (("IDE_INPUT_IMAGE", _INPUT_TEMPLATE_PATH), ("IDE_OUTPUT_IMAGE", _OUTPUT_TEMPLATE_PATH)):
+        if not path:
+            continue
+        if not Path(path).exists():
+            logger.warning("%s template not found: %s", env_name, path)
+            continue
+        if cv2 is not None:
+            try:
+                _load_template_pyramid(path)
+            except Exception as e:
+                logger.warning("%s template could not be loaded: %s", env_name, e)
+
+
+def _click_by_image(pyautogui_mod: Any, template_path: str, timeout_sec: float) -> bool:
     """
     Best-effort image-based click. This avoids hard-coded coordinates but requires stable UI visuals.
+
+    `template_path` is an already-resolved path (see _INPUT_TEMPLATE_PATH / _OUTPUT_TEMPLATE_PATH).
     """
-    if not image_path:
+    if not template_path:
         return False
-    resolved = _resolve_asset_path(image_path)
-    if not Path(resolved).exists():
-        raise RuntimeError(f"Image template not found: {resolved}")
 
-    deadline = time.time() + max(0.1, timeout_sec)
+    # With opencv: the template pyramid comes from the cache, then one grab + a coarse/fine match per attempt.
+    if cv2 is not None:
+        tpls = _load_template_pyramid(template_path)
+    else:
+        if not Path(template_path).exists():
+            raise RuntimeError(f"Image template not found: {template_path}")
+        tpls = None
+    resolved = template_path
+
+    deadline = time.monotonic() + max(0.1, timeout_sec)
     last_err: Optional[Exception] = None
-    while time.time() < deadline:
+    last_sig: Optional[bytes] = None
+    while time.monotonic() < deadline:
         try:
-            # confidence requires opencv; if missing, fall back to exact match.
-            try:
-                pos = pyautogui_mod.locateCenterOnScreen(
-                    resolved, confidence=IDE_IMAGE_CONFIDENCE, grayscale=True
-                )
-            except Exception:
-                pos = pyautogui_mod.locateCenterOnScreen(resolved, grayscale=True)
+            if tpls is not None:
+                gray = _grab_screen_gray()
+                sig = _frame_signature(gray)
+                xy = None if sig == last_sig else _match_template_center(gray, tpls)
+                last_sig = sig
+            else:
+                pos = pyautogui_mod.locateCenterOnScreen(resolved, **_LOCATE_KWARGS)
+                xy = (pos.x, pos.y) if pos else None
 
-            if pos:
-                pyautogui_mod.click(pos.x, pos.y)
+            if xy:
+                pyautogui_mod.click(xy[0], xy[1])
                 return True
         except Exception as e:
             last_err = e
-        time.sleep(0.1)
+        time.sleep(_LOCATE_POLL_SEC)
 
     if last_err:
         logger.debug("Image locate failed: %s", last_err)
     return False
 
 
+_HWND_MESSAGE = -3
+_QS_ALLINPUT = 0x04FF
+_PM_REMOVE = 0x0001
+
+
+def _clipboard_listener_open() -> Optional[int]:
+    """
+    Create a hidden message-only window subscribed to WM_CLIPBOARDUPDATE (Windows only).
+
+    Returns the window handle, or None when unavailable (caller falls back to polling).
+    """
+    if platform.system().lower() != "windows":
+        return None
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        user32 = ctypes.windll.user32
+        user32.CreateWindowExW.restype = wintypes.HWND
+        user32.CreateWindowExW.argtypes = [
+            wintypes.DWORD,
+            wintypes.LPCWSTR,
+            wintypes.LPCWSTR,
+            wintypes.DWORD,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            wintypes.HWND,
+            wintypes.HMENU,
+            wintypes.HINSTANCE,
+            wintypes.LPVOID,
+        ]
+        user32.AddClipboardFormatListener.argtypes = [wintypes.HWND]
+        user32.RemoveClipboardFormatListener.argtypes = [wintypes.HWND]
+        user32.DestroyWindow.argtypes = [wintypes.HWND]
+
+        hwnd = user32.CreateWindowExW(
+            0, "STATIC", None, 0, 0, 0, 0, 0, wintypes.HWND(_HWND_MESSAGE), None, None, None
+        )
+        if not hwnd:
+            return None
+        if not user32.AddClipboardFormatListener(hwnd):
+            user32.DestroyWindow(hwnd)
+            return None
+        return hwnd
+    except Exception as e:
+        logger.debug("Clipboard listener unavailable: %s", e)
+        return None
+
+
+def _clipboard_listener_wait(timeout_sec: float) -> None:
+    """
+    Block until this thread receives a window message (e.g. WM_CLIPBOARDUPDATE) or timeout.
+
+    WM_CLIPBOARDUPDATE is delivered to the listener window procedure while we pump, so the
+    caller simply re-reads the clipboard after waking.
+    """
+    import ctypes
+    from ctypes import wintypes
+
+    user32 = ctypes.windll.user32
+    user32.MsgWaitForMultipleObjects(0, None, False, max(0, int(timeout_sec * 1000)), _QS_ALLINPUT)
+    msg = wintypes.MSG()
+    while user32.PeekMessageW(ctypes.byref(msg), None, 0, 0, _PM_REMOVE):
+        user32.TranslateMessage(ctypes.byref(msg))
+        user32.DispatchMessageW(ctypes.byref(msg))
+
+
+def _clipboard_listener_close(hwnd: int) -> None:
+    try:
+        import ctypes
+
+        user32 = ctypes.windll.user32
+        user32.RemoveClipboardFormatListener(hwnd)
+        user32.DestroyWindow(hwnd)
+    except Exception as e:
+        logger.debug("Clipboard listener cleanup failed: %s", e)
+
+
+_CF_UNICODETEXT = 13
+_GMEM_MOVEABLE = 0x0002
+_WIN_CLIPBOARD_API: Optional[tuple] = None
+
+
+def _win_clipboard_api() -> tuple:
+    """
+    Return (user32, kernel32) with the clipboard/global-memory signatures declared (Windows only).
+    """
+    global _WIN_CLIPBOARD_API
+    if _WIN_CLIPBOARD_API is None:
+        import ctypes
+        from ctypes import wintypes
+
+        user32 = ctypes.WinDLL("user32", use_last_error=True)
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        user32.OpenClipboard.argtypes = [wintypes.HWND]
+        user32.OpenClipboard.restype = wintypes.BOOL
+        user32.CloseClipboard.restype = wintypes.BOOL
+        user32.EmptyClipboard.restype = wintypes.BOOL
+        user32.GetClipboardData.argtypes = [wintypes.UINT]
+        user32.GetClipboardData.restype = wintypes.HANDLE
+        user32.SetClipboardData.argtypes = [wintypes.UINT, wintypes.HANDLE]
+        user32.SetClipboardData.restype = wintypes.HANDLE
+        kernel32.GlobalAlloc.argtypes = [wintypes.UINT, ctypes.c_size_t]
+        kernel32.GlobalAlloc.restype = wintypes.HGLOBAL
+        kernel32.GlobalLock.argtypes = [wintypes.HGLOBAL]
+        kernel32.GlobalLock.restype = wintypes.LPVOID
+        kernel32.GlobalUnlock.argtypes = [wintypes.HGLOBAL]
+        kernel32.GlobalFree.argtypes = [wintypes.HGLOBAL]
+        user32.CreateWindowExW.restype = wintypes.HWND
+        user32.CreateWindowExW.argtypes = [
+            wintypes.DWORD,
+            wintypes.LPCWSTR,
+            wintypes.LPCWSTR,
+            wintypes.DWORD,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            wintypes.HWND,
+            wintypes.HMENU,
+            wintypes.HINSTANCE,
+            wintypes.LPVOID,
+        ]
+        user32.DestroyWindow.argtypes = [wintypes.HWND]
+        _WIN_CLIPBOARD_API = (user32, kernel32)
+    return _WIN_CLIPBOARD_API
+
+
+class _ClipboardBusy(RuntimeError):
+    """OpenClipboard kept failing: another process held the clipboard for the whole retry budget."""
+
+
+def _win_open_clipboard(user32: Any, owner: Any = None, timeout_sec: float = 0.5) -> None:
+    # Another process (often the IDE itself right after Ctrl+C) may hold the clipboard briefly;
+    # retry for up to 500 ms like pyperclip.
+    deadline = time.monotonic() + timeout_sec
+    while not user32.OpenClipboard(owner):
+        if time.monotonic() >= deadline:
+            raise _ClipboardBusy("OpenClipboard failed")
+        time.sleep(0.01)
+
+
+@contextmanager
+def _win_clipboard_owner(user32: Any) -> Iterator[Any]:
+    """
+    Hidden message-only window to own the clipboard while writing it (as pyperclip does).
+
+    After OpenClipboard(NULL), EmptyClipboard assigns ownership to NULL and SetClipboardData fails.
+    """
+    from ctypes import wintypes
+
+    hwnd = user32.CreateWindowExW(
+        0, "STATIC", None, 0, 0, 0, 0, 0, wintypes.HWND(_HWND_MESSAGE), None, None, None
+    )
+    if not hwnd:
+        raise RuntimeError("CreateWindowExW failed")
+    try:
+        yield hwnd
+    finally:
+        user32.DestroyWindow(hwnd)
+
+
+def _clipboard_get_text() -> str:
+    """
+    Read CF_UNICODETEXT with one Open/Get/Close cycle; falls back to pyperclip off Windows.
+    """
+    if not _IS_WINDOWS:
+        import pyperclip
+
+        return pyperclip.paste() or ""
+
+    import ctypes
+
+    user32, kernel32 = _win_clipboard_api()
+    _win_open_clipboard(user32)
+    try:
+        handle = user32.GetClipboardData(_CF_UNICODETEXT)
+        if not handle:
+            return ""
+        ptr = kernel32.GlobalLock(handle)
+        if not ptr:
+            return ""
+        try:
+            return ctypes.wstring_at(ptr)
+        finally:
+            kernel32.GlobalUnlock(handle)
+    finally:
+        user32.CloseClipboard()
+
+
+def _clipboard_set_text(text: str) -> None:
+    """
+    Replace the clipboard with `text` as CF_UNICODETEXT; falls back to pyperclip off Windows.
+    """
+    if not _IS_WINDOWS:
+        import pyperclip
+
+        pyperclip.copy(text)
+        return
+
+    import ctypes
+
+    user32, kernel32 = _win_clipboard_api()
+    buf = ctypes.create_unicode_buffer(text)
+    size = ctypes.sizeof(buf)
+    hmem = kernel32.GlobalAlloc(_GMEM_MOVEABLE, size)
+    if not hmem:
+        raise RuntimeError("GlobalAlloc failed")
+    ptr = kernel32.GlobalLock(hmem)
+    if not ptr:
+        kernel32.GlobalFree(hmem)
+        raise RuntimeError("GlobalLock failed")
+    ctypes.memmove(ptr, buf, size)
+    kernel32.GlobalUnlock(hmem)
+
+    try:
+        with _win_clipboard_owner(user32) as owner:
+            _win_open_clipboard(user32, owner)
+            try:
+                if not user32.EmptyClipboard() or not user32.SetClipboardData(_CF_UNICODETEXT, hmem):
+                    raise RuntimeError(f"SetClipboardData failed (error {ctypes.get_last_error()})")
+            finally:
+                user32.CloseClipboard()
+    except Exception:
+        # Ownership only transfers to the system on success.
+        kernel32.GlobalFree(hmem)
+        raise
+
+
+_WIN_SEND_INPUT: Optional[tuple] = None
+
+
+def _win_send_input_api() -> tuple:
+    """
+    Return (user32, INPUT struct type) with SendInput declared (Windows only).
+    """
+    global _WIN_SEND_INPUT
+    if _WIN_SEND_INPUT is None:
+        import ctypes
+        from ctypes import wintypes
+
+        class MOUSEINPUT(ctypes.Structure):
+            _fields_ = [
+                ("dx", wintypes.LONG),
+                ("dy", wintypes.LONG),
+                ("mouseData", wintypes.DWORD),
+                ("dwFlags", wintypes.DWORD),
+                ("time", wintypes.DWORD),
+                ("dwExtraInfo", ctypes.c_size_t),
+            ]
+
+        class KEYBDINPUT(ctypes.Structure):
+            _fields_ = [
+                ("wVk", wintypes.WORD),
+                ("wScan", wintypes.WORD),
+                ("dwFlags", wintypes.DWORD),
+                ("time", wintypes.DWORD),
+                ("dwExtraInfo", ctypes.c_size_t),
+            ]
+
+        class HARDWAREINPUT(ctypes.Structure):
+            _fields_ = [("uMsg", wintypes.DWORD), ("wParamL", wintypes.WORD), ("wParamH", wintypes.WORD)]
+
+        class _INPUTUNION(ctypes.Union):
+            _fields_ = [("mi", MOUSEINPUT), ("ki", KEYBDINPUT), ("hi", HARDWAREINPUT)]
+
+        class INPUT(ctypes.Structure):
+            _fields_ = [("type", wintypes.DWORD), ("u", _INPUTUNION)]
+
+        user32 = ctypes.WinDLL("user32", use_last_error=True)
+        user32.SendInput.argtypes = [wintypes.UINT, ctypes.POINTER(INPUT), ctypes.c_int]
+        user32.SendInput.restype = wintypes.UINT
+        user32.GetSystemMetrics.argtypes = [ctypes.c_int]
+        user32.GetSystemMetrics.restype = ctypes.c_int
+        _WIN_SEND_INPUT = (user32, INPUT)
+    return _WIN_SEND_INPUT
+
+
+def _send_drag_and_copy(start: tuple[int, int], end: tuple[int, int], steps: int = 8) -> None:
+    """
+    Drag-select from `start` to `end` with the left button, then press Ctrl+C, as one SendInput batch.
+
+    The whole sequence is queued atomically, so no other input can interleave and there is no
+    per-step sleep (pyautogui.dragTo spreads the same moves over its `duration`).
+    """
+    import ctypes
+
+    INPUT_MOUSE, INPUT_KEYBOARD = 0, 1
+    MOVE, LEFTDOWN, LEFTUP, VIRTUALDESK, ABSOLUTE = 0x0001, 0x0002, 0x0004, 0x4000, 0x8000
+    KEYUP = 0x0002
+    VK_CONTROL, VK_C = 0x11, 0x43
+
+    user32, INPUT = _win_send_input_api()
+    # Absolute coordinates are normalized to 0..65535 across the virtual desktop (all monitors).
+    vx, vy = user32.GetSystemMetrics(76), user32.GetSystemMetrics(77)
+    vw, vh = max(2, user32.GetSystemMetrics(78)), max(2, user32.GetSystemMetrics(79))
+
+    def mouse(x: float, y: float, flags: int) -> Any:
+        item = INPUT(type=INPUT_MOUSE)
+        item.u.mi.dx = int((x - vx) * 65535 / (vw - 1))
+        item.u.mi.dy = int((y - vy) * 65535 / (vh - 1))
+        item.u.mi.dwFlags = flags | MOVE | ABSOLUTE | VIRTUALDESK
+        return item
+
+    def key(vk: int, flags: int = 0) -> Any:
+        item = INPUT(type=INPUT_KEYBOARD)
+        item.u.ki.wVk = vk
+        item.u.ki.dwFlags = flags
+        return item
+
+    (x0, y0), (x1, y1) = start, end
+    events = [mouse(x0, y0, 0), mouse(x0, y0, LEFTDOWN)]
+    # A few intermediate moves so the app sees a real drag rather than a jump.
+    n = max(1, steps)
+    events += [mouse(x0 + (x1 - x0) * i / n, y0 + (y1 - y0) * i / n, 0) for i in range(1, n + 1)]
+    events += [
+        mouse(x1, y1, LEFTUP),
+        key(VK_CONTROL),
+        key(VK_C),
+        key(VK_C, KEYUP),
+        key(VK_CONTROL, KEYUP),
+    ]
+    batch = (INPUT * len(events))(*events)
+    sent = user32.SendInput(len(events), batch, ctypes.sizeof(INPUT))
+    if sent != len(events):
+        raise RuntimeError(f"SendInput injected {sent}/{len(events)} events (error {ctypes.get_last_error()})")
+
+
 def _clipboard_wait_for_change(old: str, timeout_sec: float = 3.0) -> str:
-    import pyperclip
+    # Register before the first read so a change in between is never missed.
+    listener = _clipboard_listener_open()
+    try:
+        deadline = time.monotonic() + timeout_sec
+        # Without a listener, poll fast first (copies usually land within a few ms) and back off.
+        delay = 0.005
+        cur = old
+        while True:
+            try:
+                cur = _clipboard_get_text()
+                busy = False
+            except _ClipboardBusy:
+                # Still held by the copying app: not changed yet. Its update message may already
+                # have been consumed, so poll instead of waiting on the listener.
+                busy = True
+            if cur != old and cur.strip():
+                return cur
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if listener and not busy:
+                _clipboard_listener_wait(remaining)
+            else:
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 1.5, 0.08)
+    finally:
+        if listener:
+            _clipboard_listener_close(listener)
+    # `cur` is the last successful read (read after the last wait unless the clipboard stayed busy).
+    return cur
+
+
+def _compile_marker_re(spec: str) -> Optional["re.Pattern[str]"]:
+    markers = [m.strip() for m in spec.split(",") if m.strip()]
+    if not markers:
+        return None
+    return re.compile("|".join(re.escape(m) for m in markers), re.IGNORECASE)
 
-    deadline = time.time() + timeout_sec
-    while time.time() < deadline:
-        cur = pyperclip.paste() or ""
-        if cur != old and cur.strip():
-            return cur
-        time.sleep(0.05)
-    return pyperclip.paste() or ""
+
+_MARKER_RE = _compile_marker_re(AI_ANSWER_MARKERS)
+_USER_TURN_RE = re.compile(r"(?im)^\s*(User:|You:|Me:|나:|사용자:)\s*")
+_ANCHOR_TAIL_CHARS = 4096
+
+
+def _last_lines(text: str, count: int) -> str:
+    """
+    Slice off the last `count` lines by scanning newlines backwards (no per-line list).
+    """
+    idx = len(text)
+    for _ in range(count):
+        idx = text.rfind("\n", 0, idx)
+        if idx < 0:
+            return text
+    return text[idx + 1 :]
 
 
 def _extract_last_ai_answer(full_text: str, question: str = "") -> str:
@@ -340,37 +1527,40 @@ def _extract_last_ai_answer(full_text: str, question: str = "") -> str:
     if not text:
         return ""
 
-    markers = [m.strip() for m in AI_ANSWER_MARKERS.split(",") if m.strip()]
-    lowered = text.lower()
     search_start = 0
 
     # Prefer extracting content after the latest user question anchor.
     q = (question or "").strip()
     if q:
         q_low = q.lower()
+        # The latest question is almost always near the end, so only lowercase the tail first
+        # and fall back to the whole transcript when it isn't there. The exact question is tried
+        # everywhere before the shortened anchor: a long answer restating the question's start
+        # would otherwise move the anchor inside the answer.
+        offset = max(0, len(text) - _ANCHOR_TAIL_CHARS)
+        lowered = text[offset:].lower()
         q_idx = lowered.rfind(q_low)
+        if q_idx < 0 and offset:
+            offset, lowered = 0, text.lower()
+            q_idx = lowered.rfind(q_low)
         if q_idx >= 0:
-            search_start = q_idx + len(q_low)
+            search_start = offset + q_idx + len(q_low)
         else:
             # Fuzzy fallback: find by shortened anchor if exact text differs slightly.
             anchor = q_low[: min(32, len(q_low))].strip()
-            if anchor:
-                q_idx = lowered.rfind(anchor)
-                if q_idx >= 0:
-                    search_start = q_idx + len(anchor)
-
-    # Find the last marker occurrence (case-insensitive).
-    best_idx = -1
-    best_marker = ""
-    for m in markers:
-        idx = lowered.rfind(m.lower(), search_start)
-        if idx > best_idx:
-            best_idx = idx
-            best_marker = m
-
-    if best_idx >= 0:
+            q_idx = lowered.rfind(anchor) if anchor else -1
+            if q_idx >= 0:
+                search_start = q_idx + len(anchor)
+
+    # Find the last marker occurrence (case-insensitive) in a single regex pass.
+    last_marker = None
+    if _MARKER_RE is not None:
+        for last_marker in _MARKER_RE.finditer(text, search_start):
+            pass
+
+    if last_marker is not None:
         # Return everything after the marker on that line.
-        cut = text[best_idx + len(best_marker) :].lstrip()
+        cut = text[last_marker.end() :].lstrip()
     else:
         # If no assistant marker found after question anchor, fallback to text after anchor.
         cut = text[search_start:] if search_start > 0 else text
@@ -380,8 +1570,7 @@ def _extract_last_ai_answer(full_text: str, question: str = "") -> str:
         return ""
 
     # Stop when a new user turn starts (if present in copied block).
-    user_turn_re = re.compile(r"(?im)^\s*(User:|You:|Me:|나:|사용자:)\s*")
-    m = user_turn_re.search(cut)
+    m = _USER_TURN_RE.search(cut)
     if m and m.start() > 0:
         cut = cut[: m.start()].rstrip()
 
@@ -391,9 +1580,92 @@ def _extract_last_ai_answer(full_text: str, question: str = "") -> str:
         return cut
 
     # Fallback: return the last ~120 lines (keeps UI usable).
-    lines = text.split("\n")
-    tail = "\n".join(lines[-120:])
-    return tail.strip()
+    return _last_lines(text, 120).strip()
+
+
+# HWND picked by the last chat; reused after a cheap IsWindow + title check instead of
+# enumerating every top-level window again. Only touched under _GUI_LOCK.
+_IDE_HWND: Optional[int] = None
+
+
+def _is_ide_window(hwnd: int) -> bool:
+    import ctypes
+
+    user32 = ctypes.windll.user32
+    if not hwnd or not user32.IsWindow(hwnd):
+        return False
+    buf = ctypes.create_unicode_buffer(512)
+    user32.GetWindowTextW(hwnd, buf, 512)
+    # Case-insensitive, same as pygetwindow.getWindowsWithTitle.
+    return IDE_WINDOW_TITLE_SUBSTR.upper() in buf.value.upper()
+
+
+def _score_ide_window(w: Any) -> int:
+    score = 0
+    try:
+        if getattr(w, "isActive", False):
+            score += 1_000_000
+    except Exception:
+        pass
+    try:
+        if not getattr(w, "isMinimized", False):
+            score += 100_000
+    except Exception:
+        pass
+    try:
+        score += int(getattr(w, "width", 0)) * int(getattr(w, "height", 0))
+    except Exception:
+        pass
+    return score
+
+
+def _find_ide_window(pygetwindow_mod: Any) -> Any:
+    """
+    Window matching IDE_WINDOW_TITLE_SUBSTR: the foreground window when it matches (the user may
+    have switched to another IDE instance), else the cached HWND when still valid, else the best
+    enumerated match.
+    """
+    global _IDE_HWND
+
+    hwnd = _IDE_HWND
+    try:
+        import ctypes
+
+        foreground = ctypes.windll.user32.GetForegroundWindow()
+        if foreground and foreground != hwnd and _is_ide_window(foreground):
+            _IDE_HWND = foreground
+            return pygetwindow_mod.Win32Window(foreground)
+        if hwnd and _is_ide_window(hwnd):
+            return pygetwindow_mod.Win32Window(hwnd)
+    except Exception as e:
+        logger.debug("Cached IDE window check failed: %s", e)
+    _IDE_HWND = None
+
+    wins = pygetwindow_mod.getWindowsWithTitle(IDE_WINDOW_TITLE_SUBSTR)
+    if not wins:
+        raise RuntimeError(f"No window found with title containing: {IDE_WINDOW_TITLE_SUBSTR!r}")
+    win = max(wins, key=_score_ide_window)
+    _IDE_HWND = getattr(win, "_hWnd", None)
+    return win
+
+
+def _wait_foreground(hwnd: Optional[int], timeout_sec: float) -> bool:
+    """
+    Wait until `hwnd` is the foreground window instead of sleeping a fixed settle time.
+    Without a handle this degrades to the plain sleep.
+    """
+    if not hwnd:
+        time.sleep(timeout_sec)
+        return False
+    import ctypes
+
+    user32 = ctypes.windll.user32
+    deadline = time.monotonic() + timeout_sec
+    while user32.GetForegroundWindow() != hwnd:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.005)
+    return True
 
 
 def ide_chat_via_gui(question: str) -> Dict[str, Optional[str]]:
@@ -402,48 +1674,21 @@ def ide_chat_via_gui(question: str) -> Dict[str, Optional[str]]:
     then copy the transcript to clipboard and extract the latest assistant reply.
 
     This is intentionally MVP-simple:
-    - fixed sleep for response time
+    - the transcript is re-copied until the answer stops changing (bounded by IDE_RESPONSE_WAIT_SEC)
     - click targets are configured via .env coordinates
     """
-    import pyautogui
-    import pygetwindow
-    import pyperclip
-
-    if platform.system().lower() != "windows":
-        raise RuntimeError("IDE GUI automation is only implemented for Windows right now.")
-
-    if not IDE_WINDOW_TITLE_SUBSTR:
-        raise RuntimeError("IDE_WINDOW_TITLE_SUBSTR is required for IDE chat automation.")
-
-    input_xy = _parse_xy(IDE_INPUT_POS)
-    output_xy = _parse_xy(IDE_OUTPUT_POS)
-    input_region = _parse_region(IDE_INPUT_REGION)
-    output_region = _parse_region(IDE_OUTPUT_REGION)
-
-    wins = pygetwindow.getWindowsWithTitle(IDE_WINDOW_TITLE_SUBSTR)
-    if not wins:
-        raise RuntimeError(f"No window found with title containing: {IDE_WINDOW_TITLE_SUBSTR!r}")
+    pyautogui, pygetwindow = _gui_modules()
 
-    def _score_window(w: Any) -> int:
-        score = 0
-        try:
-            if getattr(w, "isActive", False):
-                score += 1_000_000
-        except Exception:
-            pass
-        try:
-            if not getattr(w, "isMinimized", False):
-                score += 100_000
-        except Exception:
-            pass
-        try:
-            score += int(getattr(w, "width", 0)) * int(getattr(w, "height", 0))
-        except Exception:
-            pass
-        return score
+    if platform.system().lower() != "windows":
+        raise RuntimeError("IDE GUI automation is only implemented for Windows right now.")
+
+    if not IDE_WINDOW_TITLE_SUBSTR:
+        raise RuntimeError("IDE_WINDOW_TITLE_SUBSTR is required for IDE chat automation.")
 
-    def _choose_best_window(candidates: Sequence[Any]) -> Any:
-        return max(candidates, key=_score_window)
+    input_xy = _IDE_INPUT_XY
+    output_xy = _IDE_OUTPUT_XY
+    input_region = _IDE_INPUT_REGION
+    output_region = _IDE_OUTPUT_REGION
 
     def _activate_window_once(best_win: Any) -> None:
         # Prefer a robust Win32 activation path; pygetwindow.activate() can be flaky.
@@ -512,10 +1757,9 @@ def ide_chat_via_gui(question: str) -> Dict[str, Optional[str]]:
                 time.sleep(0.15)
         raise RuntimeError(f"Failed to activate window after {attempts} attempt(s): {last_exc}")
 
-    win = _choose_best_window(wins)
+    win = _find_ide_window(pygetwindow)
     _activate_window_with_retries(win, attempts=6)
-
-    time.sleep(0.15)
+    _wait_foreground(getattr(win, "_hWnd", None), 0.15)
 
     # Optional: open chat panel first (depends on your VS Code/Codex keybinding).
     if IDE_OPEN_CHAT_HOTKEY:
@@ -535,7 +1779,7 @@ def ide_chat_via_gui(question: str) -> Dict[str, Optional[str]]:
             time.sleep(0.05)
             return
 
-        clicked = _click_by_image(pyautogui, IDE_INPUT_IMAGE, IDE_IMAGE_TIMEOUT_SEC)
+        clicked = _click_by_image(pyautogui, _INPUT_TEMPLATE_PATH, IDE_IMAGE_TIMEOUT_SEC)
         if clicked:
             time.sleep(0.05)
             return
@@ -552,7 +1796,7 @@ def ide_chat_via_gui(question: str) -> Dict[str, Optional[str]]:
     def _copy_transcript_text() -> str:
         # Copy transcript/log area.
         sentinel = f"__server_vibe_clip_sentinel_{time.time_ns()}__"
-        pyperclip.copy(sentinel)
+        _clipboard_set_text(sentinel)
 
         # Focus transcript: hotkey -> region -> image -> coordinates.
         if IDE_FOCUS_TRANSCRIPT_HOTKEY:
@@ -564,7 +1808,7 @@ def ide_chat_via_gui(question: str) -> Dict[str, Optional[str]]:
                 pyautogui.click(l + w // 2, t + h // 2)
                 time.sleep(0.05)
             else:
-                clicked = _click_by_image(pyautogui, IDE_OUTPUT_IMAGE, IDE_IMAGE_TIMEOUT_SEC)
+                clicked = _click_by_image(pyautogui, _OUTPUT_TEMPLATE_PATH, IDE_IMAGE_TIMEOUT_SEC)
                 if clicked:
                     time.sleep(0.05)
                 elif output_xy:
@@ -586,11 +1830,15 @@ def ide_chat_via_gui(question: str) -> Dict[str, Optional[str]]:
                 start_y = t + int(h * 0.9)
                 end_x = l + int(w * 0.1)
                 end_y = t + int(h * 0.2)
-                pyautogui.moveTo(start_x, start_y)
-                time.sleep(0.02)
-                pyautogui.dragTo(end_x, end_y, duration=0.25, button="left")
-                time.sleep(0.05)
-                pyautogui.hotkey("ctrl", "c")
+                try:
+                    _send_drag_and_copy((start_x, start_y), (end_x, end_y))
+                except Exception as e:
+                    logger.debug("SendInput drag-copy failed, using pyautogui: %s", e)
+                    pyautogui.moveTo(start_x, start_y)
+                    time.sleep(0.02)
+                    pyautogui.dragTo(end_x, end_y, duration=0.25, button="left")
+                    time.sleep(0.05)
+                    pyautogui.hotkey("ctrl", "c")
             else:
                 pyautogui.hotkey("ctrl", "a")
                 time.sleep(0.05)
@@ -608,7 +1856,7 @@ def ide_chat_via_gui(question: str) -> Dict[str, Optional[str]]:
         return qq in body
 
     def _send_question_once(q: str, submit_spec: str) -> None:
-        pyperclip.copy(q)
+        _clipboard_set_text(q)
         _focus_input()
         pyautogui.hotkey("ctrl", "v")
         time.sleep(0.05)
@@ -617,8 +1865,53 @@ def ide_chat_via_gui(question: str) -> Dict[str, Optional[str]]:
         else:
             pyautogui.hotkey(*_hotkey_from_spec(submit_spec))
 
+    def _answer_ok(a: str) -> bool:
+        return bool(a) and a != "(no answer extracted)" and len(a.strip()) >= 4
+
+    def _marked_answer(copied: str, answer: str) -> bool:
+        # A real answer turn: an answer marker after our question, not just trailing text
+        # (a "Generating..." placeholder or the echo of the question itself).
+        if _MARKER_RE is None or not _answer_ok(answer):
+            return False
+        q = question.strip()
+        q_idx = copied.lower().rfind(q.lower())
+        return q_idx >= 0 and _MARKER_RE.search(copied, q_idx + len(q)) is not None
+
+    def _wait_for_answer(wait_sec: float) -> tuple[str, str]:
+        """
+        Re-copy the transcript every IDE_RESPONSE_POLL_SEC and return (copied, answer) early once,
+        after IDE_RESPONSE_MIN_WAIT_SEC, a marked answer has stayed unchanged for
+        IDE_RESPONSE_STABLE_SEC (streaming has finished); otherwise whatever the last copy had
+        once `wait_sec` runs out.
+        """
+        started = time.monotonic()
+        deadline = started + max(0.0, wait_sec)
+        earliest = started + min(IDE_RESPONSE_MIN_WAIT_SEC, wait_sec)
+        poll = IDE_RESPONSE_POLL_SEC if IDE_RESPONSE_POLL_SEC > 0 else wait_sec
+        prev: Optional[str] = None
+        unchanged_since = started
+        while True:
+            time.sleep(max(0.0, min(poll, deadline - time.monotonic())))
+            copied = _copy_transcript_text()
+            if _question_anchor_present(copied, question):
+                answer = _extract_last_ai_answer(copied, question=question)
+            else:
+                # We likely copied old transcript without our new question.
+                answer = ""
+            now = time.monotonic()
+            if answer != prev:
+                prev, unchanged_since = answer, now
+            elif (
+                now >= earliest
+                and now - unchanged_since >= IDE_RESPONSE_STABLE_SEC
+                and _marked_answer(copied, answer)
+            ):
+                return copied, answer
+            if now >= deadline:
+                return copied, answer
+
     # Always paste (pyautogui typewrite can't handle Korean reliably).
-    submit_specs = _submit_specs()
+    submit_specs = _IDE_SUBMIT_SPECS
     _send_question_once(question, submit_specs[0])
 
     answer = ""
@@ -626,18 +1919,10 @@ def ide_chat_via_gui(question: str) -> Dict[str, Optional[str]]:
     total_tries = max(1, 1 + IDE_SEND_RETRY_COUNT)
     for attempt in range(total_tries):
         wait_sec = IDE_RESPONSE_WAIT_SEC if attempt == 0 else IDE_RETRY_WAIT_SEC
-        time.sleep(max(0.0, wait_sec))
-
-        last_copied = _copy_transcript_text()
-        anchor_ok = _question_anchor_present(last_copied, question)
-        if not anchor_ok:
-            # We likely copied old transcript without our new question; force resend.
-            answer = ""
-        else:
-            answer = _extract_last_ai_answer(last_copied, question=question)
+        last_copied, answer = _wait_for_answer(wait_sec)
 
-        # Treat this as success if we extracted non-trivial text.
-        if answer and answer != "(no answer extracted)" and len(answer.strip()) >= 4:
+        # Treat this as success if we extracted non-trivial text; otherwise force a resend.
+        if _answer_ok(answer):
             break
 
         if attempt < total_tries - 1:
@@ -665,8 +1950,8 @@ def ide_status() -> str:
     input_region = _parse_region(IDE_INPUT_REGION)
     output_region = _parse_region(IDE_OUTPUT_REGION)
 
-    input_img = _resolve_asset_path(IDE_INPUT_IMAGE) if IDE_INPUT_IMAGE else ""
-    output_img = _resolve_asset_path(IDE_OUTPUT_IMAGE) if IDE_OUTPUT_IMAGE else ""
+    input_img = _INPUT_TEMPLATE_PATH
+    output_img = _OUTPUT_TEMPLATE_PATH
 
     lines: list[str] = []
     lines.append(f"dotenv_path: {_DOTENV_PATH}")
@@ -688,18 +1973,17 @@ def ide_status() -> str:
     lines.append(f"IDE_IMAGE_TIMEOUT_SEC: {IDE_IMAGE_TIMEOUT_SEC}")
     lines.append(f"IDE_IMAGE_CONFIDENCE: {IDE_IMAGE_CONFIDENCE}")
     lines.append(f"IDE_LEARN_COUNTDOWN_SEC: {IDE_LEARN_COUNTDOWN_SEC}")
+    lines.append(f"IDE_LEARN_DEBUG_FULLSCREEN: {IDE_LEARN_DEBUG_FULLSCREEN}")
     lines.append(f"IDE_RESPONSE_WAIT_SEC: {IDE_RESPONSE_WAIT_SEC}")
+    lines.append(f"IDE_RESPONSE_POLL_SEC: {IDE_RESPONSE_POLL_SEC}")
+    lines.append(f"IDE_RESPONSE_MIN_WAIT_SEC: {IDE_RESPONSE_MIN_WAIT_SEC}")
+    lines.append(f"IDE_RESPONSE_STABLE_SEC: {IDE_RESPONSE_STABLE_SEC}")
     lines.append(f"IDE_SEND_RETRY_COUNT: {IDE_SEND_RETRY_COUNT}")
     lines.append(f"IDE_RETRY_WAIT_SEC: {IDE_RETRY_WAIT_SEC}")
+    lines.append(f"IDE_ACTION_PAUSE_SEC: {IDE_ACTION_PAUSE_SEC}")
     lines.append(f"IDE_SUBMIT_KEYS: {IDE_SUBMIT_KEYS!r}")
 
-    try:
-        import cv2  # type: ignore
-
-        _ = cv2.__version__
-        lines.append("opencv_available: True")
-    except Exception:
-        lines.append("opencv_available: False")
+    lines.append(f"opencv_available: {cv2 is not None}")
 
     focus_ok = bool(IDE_CHAT_FOCUS_HOTKEY or input_region or IDE_INPUT_IMAGE or input_xy)
     transcript_ok = bool(IDE_FOCUS_TRANSCRIPT_HOTKEY or output_region or IDE_OUTPUT_IMAGE or output_xy)
@@ -737,27 +2021,21 @@ def ide_status() -> str:
 
 
 def _storage_public_url_from_upload(object_path: str) -> str:
-    public_url_result = supabase.storage.from_("screenshots").get_public_url(object_path)
+    if _PUBLIC_URL_BASE:
+        return _PUBLIC_URL_BASE + object_path
+
+    # Non-standard host (self-hosted/proxy): let the Storage API build it.
+    public_url_result = _supabase_client().storage.from_("screenshots").get_public_url(object_path)
     if isinstance(public_url_result, dict):
         return public_url_result.get("publicURL") or public_url_result.get("publicUrl") or ""
     return str(public_url_result)
 
 
 def ide_debug_screen(user_id: str, label: str = "ide_debug_screen") -> Dict[str, str]:
-    import pyautogui
-
-    now = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    now = _utc_stamp()
     object_path = f"{user_id}/debug/{label}_{now}.png"
-    with tempfile.TemporaryDirectory() as tmpdir:
-        local_path = Path(tmpdir) / "debug.png"
-        img = pyautogui.screenshot()
-        img.save(local_path)
-        with open(local_path, "rb") as f:
-            supabase.storage.from_("screenshots").upload(
-                object_path,
-                f,
-                {"content-type": "image/png", "upsert": "true"},
-            )
+    img = _grab_screen()
+    _upload_png(object_path, _encode_png(img, palette=True))
     image_url = _storage_public_url_from_upload(object_path)
     return {"log": f"Uploaded debug screen: {object_path}", "image_url": image_url}
 
@@ -766,61 +2044,62 @@ def ide_debug_locate(user_id: str, kind: str) -> Dict[str, Optional[str]]:
     """
     Try to locate input/output template on screen, and upload an annotated screenshot.
     """
-    import pyautogui
     from PIL import ImageDraw
 
+    pyautogui = _pyautogui()
+
     if kind not in ("input", "output"):
         raise ValueError("Usage: /ide debug locate input|output")
 
-    template_env = IDE_INPUT_IMAGE if kind == "input" else IDE_OUTPUT_IMAGE
-    if not template_env:
+    template_path = _INPUT_TEMPLATE_PATH if kind == "input" else _OUTPUT_TEMPLATE_PATH
+    if not template_path:
         raise RuntimeError(f"IDE_{kind.upper()}_IMAGE is empty. Set it to an image template path first.")
 
-    template_path = _resolve_asset_path(template_env)
-    if not Path(template_path).exists():
-        raise RuntimeError(f"Image template not found: {template_path}")
+    # Same matcher as _click_by_image so this reports what a real click would find.
+    if cv2 is not None:
+        tpls = _load_template_pyramid(template_path)
+    else:
+        if not Path(template_path).exists():
+            raise RuntimeError(f"Image template not found: {template_path}")
+        tpls = None
 
     box = None
     last_err: Optional[Exception] = None
-    deadline = time.time() + max(0.1, IDE_IMAGE_TIMEOUT_SEC)
-    while time.time() < deadline and box is None:
+    deadline = time.monotonic() + max(0.1, IDE_IMAGE_TIMEOUT_SEC)
+    last_sig: Optional[bytes] = None
+    while time.monotonic() < deadline and box is None:
         try:
-            try:
-                box = pyautogui.locateOnScreen(
-                    template_path, confidence=IDE_IMAGE_CONFIDENCE, grayscale=True
-                )
-            except Exception:
-                box = pyautogui.locateOnScreen(template_path, grayscale=True)
+            if tpls is not None:
+                gray = _grab_screen_gray()
+                sig = _frame_signature(gray)
+                box = None if sig == last_sig else _match_template_box(gray, tpls)
+                last_sig = sig
+            else:
+                found = pyautogui.locateOnScreen(template_path, **_LOCATE_KWARGS)
+                if found is not None:
+                    box = (int(found.left), int(found.top), int(found.width), int(found.height))
         except Exception as e:
             last_err = e
         if box is None:
-            time.sleep(0.1)
+            time.sleep(_LOCATE_POLL_SEC)
 
-    img = pyautogui.screenshot()
+    img = _grab_screen()
     draw = ImageDraw.Draw(img)
 
     status = "not_found"
     details = f"template={template_path} timeout={IDE_IMAGE_TIMEOUT_SEC}s conf={IDE_IMAGE_CONFIDENCE}"
     if box is not None:
         status = "found"
-        left, top, width, height = int(box.left), int(box.top), int(box.width), int(box.height)
+        left, top, width, height = box
         draw.rectangle([left, top, left + width, top + height], outline=(255, 0, 0), width=6)
         draw.rectangle([left - 2, top - 2, left + width + 2, top + height + 2], outline=(255, 255, 255), width=2)
         details = f"{details}\nbox=({left},{top},{width},{height})"
     elif last_err is not None:
         details = f"{details}\nlocate_error={last_err}"
 
-    now = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    now = _utc_stamp()
     object_path = f"{user_id}/debug/locate_{kind}_{status}_{now}.png"
-    with tempfile.TemporaryDirectory() as tmpdir:
-        local_path = Path(tmpdir) / "annotated.png"
-        img.save(local_path)
-        with open(local_path, "rb") as f:
-            supabase.storage.from_("screenshots").upload(
-                object_path,
-                f,
-                {"content-type": "image/png", "upsert": "true"},
-            )
+    _upload_png(object_path, _encode_png(img, palette=True))
     image_url = _storage_public_url_from_upload(object_path)
 
     return {"log": f"/ide debug locate {kind}: {status}\n{details}", "image_url": image_url}
@@ -831,9 +2110,10 @@ def _upsert_env_vars(env_path: Path, updates: Dict[str, str]) -> None:
     Upsert KEY=VALUE lines into .env while preserving other lines/comments.
     """
     env_path = env_path.resolve()
-    lines: list[str] = []
+    original = ""
     if env_path.exists():
-        lines = env_path.read_text(encoding="utf-8").splitlines()
+        original = env_path.read_text(encoding="utf-8")
+    lines = original.splitlines()
 
     # Track which keys we've replaced.
     replaced: set[str] = set()
@@ -856,7 +2136,18 @@ def _upsert_env_vars(env_path: Path, updates: Dict[str, str]) -> None:
         if k not in replaced:
             out.append(f"{k}={v}")
 
-    env_path.write_text("\n".join(out) + "\n", encoding="utf-8")
+    text = "\n".join(out) + "\n"
+    if text == original:
+        # Recalibrating to the same values: leave the file alone.
+        return
+    # Write a sibling temp file and swap it in, so a crash never leaves a half-written .env.
+    tmp_path = env_path.with_name(env_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        # Durable before the rename, or a power cut could still leave an empty .env behind it.
+        os.fsync(f.fileno())
+    os.replace(tmp_path, env_path)
 
 
 def ide_calibrate_regions() -> Dict[str, str]:
@@ -944,12 +2235,16 @@ def ide_calibrate_output_region() -> Dict[str, str]:
     }
 
 
+# Margin (px) of screen context kept around a learned region in its debug preview.
+_LEARN_DEBUG_PAD = 64
+
+
 def _learn_template_at_mouse(user_id: str, kind: str) -> Dict[str, str]:
     """
     Save a small screenshot region around current mouse position as a template image.
     This helps avoid per-user coordinate config.
     """
-    import pyautogui
+    pyautogui = _pyautogui()
 
     if kind not in ("input", "output"):
         raise ValueError("kind must be 'input' or 'output'")
@@ -964,50 +2259,48 @@ def _learn_template_at_mouse(user_id: str, kind: str) -> Dict[str, str]:
     left = max(0, int(p.x - w // 2))
     top = max(0, int(p.y - h // 2))
 
-    assets_dir = Path(__file__).resolve().parent / "assets"
+    assets_dir = _AGENT_DIR / "assets"
     assets_dir.mkdir(parents=True, exist_ok=True)
     out_path = assets_dir / f"ide_{kind}_template.png"
 
-    img = pyautogui.screenshot(region=(left, top, w, h))
-    img.save(out_path)
+    # One region grab serves both the template and the debug preview around it.
+    pad_left = max(0, left - _LEARN_DEBUG_PAD)
+    pad_top = max(0, top - _LEARN_DEBUG_PAD)
+    around = _grab_region(pad_left, pad_top, left + w + _LEARN_DEBUG_PAD - pad_left, top + h + _LEARN_DEBUG_PAD - pad_top)
+    ox, oy = left - pad_left, top - pad_top
+    img = around.crop((ox, oy, ox + w, oy + h))
+    # Encode once: the same bytes go to disk (template) and to Storage (preview).
+    template_png = _encode_png(img)
+    out_path.write_bytes(template_png)
+    # The file may back IDE_*_IMAGE; drop any decoded copy so the next locate re-reads it.
+    if cv2 is not None:
+        _load_template_gray.cache_clear()
 
     # Upload so you can visually confirm the template from the web UI.
-    now = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    now = _utc_stamp()
     object_path = f"{user_id}/templates/ide_{kind}_template_{now}.png"
-    with open(out_path, "rb") as f:
-        supabase.storage.from_("screenshots").upload(
-            object_path,
-            f,
-            {"content-type": "image/png", "upsert": "true"},
-        )
+    # The template is already saved locally; the Storage copies are previews, so upload them in the
+    # background (public URLs are derived from the path and don't need the upload to finish).
+    _upload_png_background(object_path, template_png)
 
-    public_url_result = supabase.storage.from_("screenshots").get_public_url(object_path)
-    if isinstance(public_url_result, dict):
-        image_url = public_url_result.get("publicURL") or public_url_result.get("publicUrl") or ""
-    else:
-        image_url = str(public_url_result)
+    image_url = _storage_public_url_from_upload(object_path)
 
-    # Also upload a full-screen debug image marking the captured region.
+    # Also upload a debug image marking the captured region (with some context around it).
     debug_object_path = f"{user_id}/debug/learn_{kind}_region_{now}.png"
     try:
         from PIL import ImageDraw
 
-        full = pyautogui.screenshot()
-        draw = ImageDraw.Draw(full)
-        draw.rectangle([left, top, left + w, top + h], outline=(255, 0, 0), width=8)
-        draw.rectangle([left - 2, top - 2, left + w + 2, top + h + 2], outline=(255, 255, 255), width=2)
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            local_path = Path(tmpdir) / "learn_region.png"
-            full.save(local_path)
-            with open(local_path, "rb") as f:
-                supabase.storage.from_("screenshots").upload(
-                    debug_object_path,
-                    f,
-                    {"content-type": "image/png", "upsert": "true"},
-                )
+        if IDE_LEARN_DEBUG_FULLSCREEN:
+            debug_img, dx, dy = _grab_screen(), left, top
+        else:
+            debug_img, dx, dy = around, ox, oy
+        draw = ImageDraw.Draw(debug_img)
+        draw.rectangle([dx, dy, dx + w, dy + h], outline=(255, 0, 0), width=8)
+        draw.rectangle([dx - 2, dy - 2, dx + w + 2, dy + h + 2], outline=(255, 255, 255), width=2)
+
+        _upload_image_background(debug_object_path, debug_img, palette=True)
     except Exception as e:
-        logger.debug("Failed to upload learn debug image: %s", e)
+        logger.debug("Failed to build learn debug image: %s", e)
 
     debug_url = _storage_public_url_from_upload(debug_object_path)
 
@@ -1020,234 +2313,713 @@ def _learn_template_at_mouse(user_id: str, kind: str) -> Dict[str, str]:
     }
 
 
-def handle_command(payload: Dict[str, Any]) -> None:
-    row = payload.get("new", payload)
+_CLAIM_RPC_AVAILABLE = True
+
+
+def _claim_command(command_id: str) -> bool:
+    """
+    Atomically move a command from pending -> processing. Returns True if we own it now.
+
+    Uses the `claim_command` RPC (see supabase_step1.sql): one round-trip, UPDATE ... RETURNING.
+    Falls back to a conditional UPDATE when the function isn't installed yet.
+    """
+    global _CLAIM_RPC_AVAILABLE
+    if _CLAIM_RPC_AVAILABLE:
+        try:
+            res = _supabase_client().rpc("claim_command", {"cmd_id": command_id, "p_agent": AGENT_ID}).execute()
+            return bool(res.data)
+        except Exception as e:
+            # PGRST202: function not found in the schema cache.
+            if getattr(e, "code", None) != "PGRST202":
+                raise
+            logger.warning("claim_command RPC not found; run supabase_step1.sql. Using UPDATE fallback.")
+            _CLAIM_RPC_AVAILABLE = False
+
+    claim = (
+        _supabase_client().table("commands")
+        .update({"status": "processing", "response_log": "Command received"})
+        .eq("id", command_id)
+        .eq("status", "pending")
+        .execute()
+    )
+    return bool(claim.data)
+
+
+_CLAIM_BATCH_RPC_AVAILABLE = True
+
+# The poll's REST requests never change between ticks, so build them once and send them
+# straight through the pooled httpx session instead of rebuilding a PostgREST query chain.
+_REST_BASE = f"{SUPABASE_URL.rstrip('/')}/rest/v1"
+_REST_HEADERS = {
+    "apikey": SUPABASE_KEY,
+    "Authorization": f"Bearer {SUPABASE_KEY}",
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+}
+_CLAIM_BATCH_URL = f"{_REST_BASE}/rpc/claim_pending_commands"
+_UPSERT_URL = f"{_REST_BASE}/commands?on_conflict=id"
+_UPSERT_HEADERS = {**_REST_HEADERS, "Prefer": "resolution=merge-duplicates,return=minimal"}
+
+
+@functools.lru_cache(maxsize=4)
+def _pending_select_url(limit: int) -> str:
+    url = (
+        f"{_REST_BASE}/commands?select=id,user_id,command_text"
+        f"&status=eq.pending&order=created_at.asc&limit={limit}"
+    )
+    if AGENT_USER_ID:
+        url += f"&user_id=eq.{AGENT_USER_ID}"
+    return url
+
+
+def _json_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj).encode("utf-8")
+
+
+def _json_loads(raw: bytes) -> Any:
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _rest_request(
+    method: str,
+    url: str,
+    body: Any = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> Any:
+    """
+    Send a prebuilt PostgREST request over the shared session; errors raise APIError like postgrest-py.
+    """
+    from postgrest.exceptions import APIError
+
+    resp = _supabase_client().postgrest.session.request(
+        method,
+        url,
+        headers=headers or _REST_HEADERS,
+        content=_json_dumps(body) if body is not None else None,
+    )
+    if resp.status_code >= 400:
+        try:
+            err = _json_loads(resp.content)
+        except ValueError:
+            err = {"message": resp.text}
+        raise APIError(err if isinstance(err, dict) else {"message": str(err)})
+    # return=minimal (upserts) answers 201/204 with no body.
+    return _json_loads(resp.content) if resp.content else None
+
+
+def _fetch_pending_commands(limit: int) -> tuple[list[Dict[str, Any]], bool]:
+    """
+    Return (rows, claimed). Prefers the `claim_pending_commands` RPC, which claims and returns
+    up to `limit` pending rows in one round-trip (FOR UPDATE SKIP LOCKED, so concurrent agents
+    never get the same row). Falls back to a plain SELECT (rows claimed one by one later).
+    """
+    global _CLAIM_BATCH_RPC_AVAILABLE
+    if _CLAIM_BATCH_RPC_AVAILABLE:
+        try:
+            data = _rest_request(
+                "POST",
+                _CLAIM_BATCH_URL,
+                {"p_user": AGENT_USER_ID or None, "p_batch": limit, "p_agent": AGENT_ID},
+            )
+            rows = sorted(data or [], key=lambda r: r.get("created_at") or "")
+            return rows, True
+        except Exception as e:
+            if getattr(e, "code", None) != "PGRST202":
+                raise
+            logger.warning("claim_pending_commands RPC not found; run supabase_step1.sql. Using SELECT fallback.")
+            _CLAIM_BATCH_RPC_AVAILABLE = False
+
+    return _rest_request("GET", _pending_select_url(limit)) or [], False
+
+
+def _report_learned(command_id: str, kind: str, learned: Dict[str, str]) -> None:
+    update_command(
+        command_id,
+        "completed",
+        response_log=(
+            f"Saved {kind} template: {learned['path']}\n"
+            f"mouse_pos={learned.get('mouse_pos')}\n"
+            f"region={learned.get('region')}\n"
+            f"template_url={learned.get('image_url')}\n"
+            f"Set IDE_{kind.upper()}_IMAGE=assets\\ide_{kind}_template.png"
+        ),
+        image_url=learned.get("debug_image_url") or learned.get("image_url") or None,
+    )
+
+
+def _report_result(command_id: str, result: Dict[str, Any]) -> None:
+    update_command(command_id, "completed", response_log=result["log"], image_url=result["image_url"])
+
+
+def _cmd_pos(command_id: str, user_id: str, arg: str) -> None:
+    p = _pyautogui().position()
+    update_command(command_id, "completed", response_log=f"{p.x},{p.y}")
+
+
+def _cmd_capture(command_id: str, user_id: str, arg: str) -> None:
+    # Only the grab needs the GUI lock; the upload runs outside it, so back-to-back captures
+    # overlap their uploads with the next grab instead of queueing behind them.
+    with _GUI_LOCK:
+        screenshot = _grab_screen()
+    _report_result(command_id, upload_capture(user_id, _encode_png(screenshot)))
+
+
+def _cmd_open(command_id: str, user_id: str, arg: str) -> None:
+    if not arg:
+        raise ValueError("Usage: /open [app_name]")
+    update_command(command_id, "completed", response_log=open_app(arg))
+
+
+def _cmd_sh(command_id: str, user_id: str, arg: str) -> None:
+    if not arg:
+        raise ValueError("Usage: /sh [shell command]")
+    update_command(command_id, "completed", response_log=run_shell_command(command_id, arg))
+
+
+def _cmd_whoami(command_id: str, user_id: str, arg: str) -> None:
+    # Back-compat: allow the classic smoke-test command without requiring /sh.
+    update_command(command_id, "completed", response_log=run_shell_command(command_id, "whoami"))
+
+
+def _cmd_ide_debug_locate(command_id: str, user_id: str, arg: str) -> None:
+    _report_result(command_id, ide_debug_locate(user_id, arg.strip().lower()))
+
+
+# "/ide <sub>" commands matched exactly on <sub>; only "debug locate" takes an argument.
+_IDE_COMMANDS: Dict[str, Callable[[str, str], None]] = {
+    "learn input": lambda cid, uid: _report_learned(cid, "input", _learn_template_at_mouse(uid, "input")),
+    "learn output": lambda cid, uid: _report_learned(cid, "output", _learn_template_at_mouse(uid, "output")),
+    "status": lambda cid, uid: update_command(cid, "completed", response_log=ide_status()),
+    "calibrate regions": lambda cid, uid: update_command(cid, "completed", response_log=ide_calibrate_regions()["log"]),
+    "calibrate input": lambda cid, uid: update_command(cid, "completed", response_log=ide_calibrate_input_region()["log"]),
+    "calibrate output": lambda cid, uid: update_command(cid, "completed", response_log=ide_calibrate_output_region()["log"]),
+    "debug screen": lambda cid, uid: _report_result(cid, ide_debug_screen(uid)),
+}
+
+
+def _cmd_ide(command_id: str, user_id: str, arg: str) -> bool:
+    sub = _IDE_COMMANDS.get(arg)
+    if sub is not None:
+        sub(command_id, user_id)
+        return True
+    if arg.startswith("debug locate "):
+        _cmd_ide_debug_locate(command_id, user_id, arg[len("debug locate ") :])
+        return True
+    return False
+
+
+# (handler(command_id, user_id, arg), takes_argument, needs_gui)
+_CommandEntry = tuple[Callable[[str, str, str], Any], bool, bool]
+
+# First word of command_text -> entry. Commands that don't take an argument only match exactly;
+# anything unmatched is sent to the IDE chat.
+_COMMANDS: Dict[str, _CommandEntry] = {
+    "/pos": (_cmd_pos, False, True),
+    "/capture": (_cmd_capture, False, False),  # takes the GUI lock itself, for the grab only
+    "/open": (_cmd_open, True, True),
+    "/sh": (_cmd_sh, True, False),
+    "whoami": (_cmd_whoami, False, False),
+    "/ide": (_cmd_ide, True, True),
+}
+
+# Optional routing prefix for IDE chat ("@ag ", "@vscode ", ...). It is stripped before sending;
+# which IDE receives the question is decided by IDE_WINDOW_TITLE_SUBSTR (one agent per IDE).
+_CHAT_PREFIXES = ("@ag", "@antigravity", "@vscode", "@cursor")
+
+
+def _literal_alternation(words: Sequence[str]) -> str:
+    # Longest first, so "@antigravity" is never shadowed by "@ag".
+    return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+
+# One anchored pass over command_text: either a command word (+ optional argument) from
+# _COMMANDS, or a chat routing prefix followed by the question.
+_ROUTE_RE = re.compile(
+    r"(?P<cmd>{cmds})(?: +(?P<arg>.*))?\Z|(?P<chat>{prefixes})(?: +(?P<q>.*))?\Z".format(
+        cmds=_literal_alternation(list(_COMMANDS)), prefixes=_literal_alternation(_CHAT_PREFIXES)
+    ),
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def _route_command(command_text: str) -> tuple[Optional[_CommandEntry], str]:
+    """
+    Resolve (table entry, argument) with a single _ROUTE_RE match.
+    A None entry means IDE chat, with the argument being the question to send.
+    """
+    m = _ROUTE_RE.match(command_text)
+    if m is not None:
+        if m.group("cmd"):
+            entry = _COMMANDS[m.group("cmd").lower()]
+            arg = (m.group("arg") or "").strip()
+            if not arg or entry[1]:
+                return entry, arg
+        else:
+            return None, (m.group("q") or "").strip()
+    return None, command_text
+
+
+def _chat(command_id: str, question: str) -> None:
+    # A bare routing prefix ("@ag") leaves nothing to ask; fail before any window focus/typing.
+    if not question:
+        raise ValueError("Empty question: nothing to send to the IDE chat")
+    result = ide_chat_via_gui(question)
+    update_command(command_id, "completed", response_log=result["log"], image_url=result["image_url"])
+
+
+def _run_command(command_id: str, user_id: str, command_text: str) -> None:
+    """
+    Execute an already-claimed command and report its final status.
+    """
+    entry, arg = _route_command(command_text)
+    if entry is not None:
+        handled = entry[0](command_id, user_id, arg)
+        # Only "/ide" can decline (unknown sub-command); it then goes to the IDE chat.
+        if handled is not False:
+            return
+        arg = command_text
+    _chat(command_id, arg)
+
+
+def _unpack_row(row: Dict[str, Any], claimed: bool = False) -> Optional[tuple[str, str, str]]:
+    """
+    Boundary check for a command row: (id, user_id, command_text), or None to skip it.
+    """
+    row = row.get("new", row)
     command_id = row.get("id")
     user_id = row.get("user_id")
-    command_text = (row.get("command_text") or "").strip()
-    status = row.get("status")
 
     if not command_id or not user_id:
         logger.warning("Skipping malformed row: %s", row)
-        return
+        return None
 
     if AGENT_USER_ID and user_id != AGENT_USER_ID:
-        return
+        return None
 
-    if status != "pending":
-        return
+    # The poll SELECT only returns pending rows and doesn't fetch the column; realtime rows carry it.
+    if not claimed and row.get("status", "pending") != "pending":
+        return None
+
+    return command_id, user_id, row.get("command_text") or ""
 
+
+def handle_command(
+    command_id: str,
+    user_id: str,
+    raw_text: str,
+    claimed: bool = False,
+    batch: Optional[list[Dict[str, Any]]] = None,
+) -> None:
+    """
+    Claim and run one command. `claimed=True` means the row came from
+    claim_pending_commands and is already ours (status "processing"); `batch` is the
+    poll batch (from _batched_updates) whose upsert may carry the final status.
+    """
+    command_text = raw_text.strip()
     if not command_text:
         update_command(command_id, "error", response_log="Empty command_text")
         return
 
     # Claim the job atomically to avoid double-processing if the agent is run twice.
-    claim = (
-        supabase.table("commands")
-        .update({"status": "processing", "response_log": "Command received"})
-        .eq("id", command_id)
-        .eq("status", "pending")
-        .execute()
-    )
-    claimed_rows = claim.data or []
-    if not claimed_rows:
+    if not claimed and not _claim_command(command_id):
         return
 
+    # Identity for a batched upsert of the final status (ignored once the batch is closed).
+    _CURRENT_COMMAND.row = {"id": command_id, "user_id": user_id, "command_text": raw_text}
+    _CURRENT_COMMAND.batch = batch
+
     logger.info("Processing command %s: %s", command_id, command_text)
+    started = time.monotonic()
 
+    # Other users' shell commands may run alongside; anything that drives the mouse/keyboard/screen
+    # takes the GUI lock so two commands never fight over focus.
+    entry, _ = _route_command(command_text)
+    needs_gui = entry is None or entry[2]
     try:
-        if command_text == "/pos":
-            import pyautogui
+        with (_GUI_LOCK if needs_gui else nullcontext()):
+            _run_command(command_id, user_id, command_text)
+    except Exception as exc:
+        logger.exception("Command failed: %s", command_id)
+        update_command(command_id, "error", response_log=str(exc))
+    finally:
+        # Lane threads run many commands; never let the next one inherit this identity.
+        _CURRENT_COMMAND.row = None
+        _CURRENT_COMMAND.batch = None
+        _note_command_duration(time.monotonic() - started)
 
-            p = pyautogui.position()
-            update_command(command_id, "completed", response_log=f"{p.x},{p.y}")
-            return
 
-        if command_text == "/ide learn input":
-            learned = _learn_template_at_mouse(user_id, "input")
-            update_command(
-                command_id,
-                "completed",
-                response_log=(
-                    f"Saved input template: {learned['path']}\n"
-                    f"mouse_pos={learned.get('mouse_pos')}\n"
-                    f"region={learned.get('region')}\n"
-                    f"template_url={learned.get('image_url')}\n"
-                    "Set IDE_INPUT_IMAGE=assets\\ide_input_template.png"
-                ),
-                image_url=learned.get("debug_image_url") or learned.get("image_url") or None,
-            )
-            return
+# EWMA of command run time, read by the poller to size its claim batches.
+_AVG_COMMAND_SEC = 0.0
+_AVG_LOCK = threading.Lock()
 
-        if command_text == "/ide learn output":
-            learned = _learn_template_at_mouse(user_id, "output")
-            update_command(
-                command_id,
-                "completed",
-                response_log=(
-                    f"Saved output template: {learned['path']}\n"
-                    f"mouse_pos={learned.get('mouse_pos')}\n"
-                    f"region={learned.get('region')}\n"
-                    f"template_url={learned.get('image_url')}\n"
-                    "Set IDE_OUTPUT_IMAGE=assets\\ide_output_template.png"
-                ),
-                image_url=learned.get("debug_image_url") or learned.get("image_url") or None,
-            )
-            return
 
-        if command_text == "/ide status":
-            update_command(command_id, "completed", response_log=ide_status())
-            return
+def _note_command_duration(seconds: float) -> None:
+    global _AVG_COMMAND_SEC
+    with _AVG_LOCK:
+        _AVG_COMMAND_SEC = 0.9 * _AVG_COMMAND_SEC + 0.1 * seconds
 
-        if command_text == "/ide calibrate regions":
-            result = ide_calibrate_regions()
-            update_command(command_id, "completed", response_log=result["log"])
-            return
 
-        if command_text == "/ide calibrate input":
-            result = ide_calibrate_input_region()
-            update_command(command_id, "completed", response_log=result["log"])
-            return
+def _next_batch_size(avg_rows: float) -> int:
+    """
+    Claim roughly twice the recent arrival rate, capped at POLL_MAX_BATCH. While commands are
+    slow (long GUI chats), claim one at a time so queued rows stay free for other agents.
+    """
+    if _AVG_COMMAND_SEC > POLL_INTERVAL_SEC * 10:
+        return 1
+    return max(1, min(POLL_MAX_BATCH, math.ceil(avg_rows * 2)))
 
-        if command_text == "/ide calibrate output":
-            result = ide_calibrate_output_region()
-            update_command(command_id, "completed", response_log=result["log"])
-            return
 
-        if command_text == "/ide debug screen":
-            result = ide_debug_screen(user_id)
-            update_command(
-                command_id,
-                "completed",
-                response_log=result["log"],
-                image_url=result["image_url"],
-            )
-            return
+def recover_orphaned_commands() -> None:
+    """
+    Fail rows this agent (AGENT_ID) left in "processing" in a previous run (crash/kill
+    mid-command). Rows claimed by other agents are theirs to finish, however old.
 
-        if command_text.startswith("/ide debug locate "):
-            kind = command_text.replace("/ide debug locate ", "", 1).strip().lower()
-            result = ide_debug_locate(user_id, kind)
-            update_command(
-                command_id,
-                "completed",
-                response_log=result["log"],
-                image_url=result["image_url"],
-            )
-            return
+    Pending rows need no startup scan: the poller's first tick claims them. Orphans are marked
+    as errors rather than re-queued, since re-running e.g. a /sh command may not be safe.
+    """
+    # Only for rows claimed before claimed_by existed (see supabase_step1.sql).
+    stale_sec = max(COMMAND_TIMEOUT_SEC * 2, 300)
+    try:
+        data = _rest_request(
+            "POST",
+            f"{_REST_BASE}/rpc/fail_orphaned_commands",
+            {"p_user": AGENT_USER_ID or None, "p_agent": AGENT_ID, "p_stale_seconds": stale_sec},
+        )
+    except Exception as e:
+        if getattr(e, "code", None) == "PGRST202":
+            logger.info("fail_orphaned_commands RPC not found; skipping orphan recovery (see supabase_step1.sql)")
+        else:
+            logger.warning("Orphan recovery failed: %s", e)
+        return
+    if data:
+        logger.warning("Marked %d orphaned command(s) from a previous run as error", len(data))
 
-        if command_text == "/capture":
-            result = capture_screen(user_id)
-            update_command(
-                command_id,
-                "completed",
-                response_log=result["log"],
-                image_url=result["image_url"],
-            )
-            return
 
-        if command_text.startswith("/open "):
-            app_name = command_text.replace("/open ", "", 1).strip()
-            if not app_name:
-                raise ValueError("Usage: /open [app_name]")
-            out = open_app(app_name)
-            update_command(command_id, "completed", response_log=out)
-            return
+# Wakes the poll loop: a realtime row arrived, a re-poll was requested, or shutdown.
+_WAKE = threading.Event()
+_REPOLL = threading.Event()
+_STOP = threading.Event()
+# Completed together with _STOP, so a wait() on command futures also returns on shutdown.
+_STOP_FUTURE: Future = Future()
 
-        # Back-compat: allow the classic smoke-test command without requiring /sh.
-        if command_text.strip().lower() == "whoami":
-            out = run_shell_command(command_id, "whoami")
-            update_command(command_id, "completed", response_log=out)
-            return
+_REALTIME_ROWS: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+_REALTIME_READY = threading.Event()
+_REALTIME_STOP = threading.Event()
+# (event loop, stop event) of the running listener, so shutdown can unsubscribe from another thread.
+_REALTIME_LOOP: Optional[tuple] = None
 
-        # Safety: default is IDE chat. Shell execution requires explicit /sh prefix.
-        if command_text.startswith("/sh "):
-            shell_text = command_text.replace("/sh ", "", 1).strip()
-            if not shell_text:
-                raise ValueError("Usage: /sh [shell command]")
-            out = run_shell_command(command_id, shell_text)
-            update_command(command_id, "completed", response_log=out)
-            return
 
-        # Optional routing: "@ag " / "@vscode " / "@cursor " prefix.
-        q = command_text
-        target = IDE_TARGET
-        for prefix, t in (("@ag ", "antigravity"), ("@antigravity ", "antigravity"), ("@vscode ", "vscode"), ("@cursor ", "cursor")):
-            if q.lower().startswith(prefix):
-                q = q[len(prefix) :].lstrip()
-                target = t
-                break
+def _realtime_row(payload: Any) -> Optional[Dict[str, Any]]:
+    # realtime-py 2.x: {"data": {"record": {...}}}; older shapes used "new"/"record".
+    if not isinstance(payload, dict):
+        return None
+    data = payload.get("data")
+    if isinstance(data, dict) and isinstance(data.get("record"), dict):
+        return data["record"]
+    for key in ("new", "record"):
+        if isinstance(payload.get(key), dict):
+            return payload[key]
+    return None
 
-        # For now, target selection only changes which window title you configure in .env.
-        # You can run multiple agents with different IDE_WINDOW_TITLE_SUBSTR + IDE_TARGET if needed.
-        _ = target  # reserved for future per-target profiles.
-        result = ide_chat_via_gui(q)
-        update_command(command_id, "completed", response_log=result["log"], image_url=result["image_url"])
 
-    except Exception as exc:
-        logger.exception("Command failed: %s", command_id)
-        update_command(command_id, "error", response_log=str(exc))
+# How often the listener checks that the realtime socket is still up.
+_REALTIME_HEALTH_SEC = 5.0
 
 
-def bootstrap_pending_commands() -> None:
-    query = (
-        supabase.table("commands")
-        .select("id,user_id,command_text,status")
-        .eq("status", "pending")
-        .order("created_at", desc=False)
-        .limit(50)
-    )
+def _realtime_alive(client: Any) -> bool:
+    """
+    False once the socket is gone: closed cleanly (realtime-py doesn't reconnect on
+    ConnectionClosedOK) or its listen task gave up reconnecting. Channel-state callbacks
+    don't fire in either case.
+    """
+    if not getattr(client, "is_connected", True):
+        return False
+    task = getattr(client, "_listen_task", None)
+    return task is None or not task.done()
 
-    if AGENT_USER_ID:
-        query = query.eq("user_id", AGENT_USER_ID)
 
-    response = query.execute()
+async def _realtime_main() -> None:
+    from realtime import AsyncRealtimeClient
 
-    rows = response.data or []
-    if rows:
-        logger.info("Found %d pending command(s) on startup", len(rows))
-    for row in rows:
-        handle_command(row)
+    client = AsyncRealtimeClient(f"{SUPABASE_URL.rstrip('/')}/realtime/v1", token=SUPABASE_KEY)
+    await client.connect()
+
+    def on_insert(payload: Any) -> None:
+        # Never run handlers on the event loop (GUI automation blocks for seconds).
+        row = _realtime_row(payload)
+        if row:
+            _REALTIME_ROWS.put(row)
+            _WAKE.set()
+
+    def on_state(state: Any, err: Optional[Exception] = None) -> None:
+        if state == "SUBSCRIBED":
+            logger.info("Realtime subscribed to public.commands inserts")
+            _REALTIME_READY.set()
+        else:
+            logger.warning("Realtime channel state: %s %s", state, err or "")
+            _REALTIME_READY.clear()
+            # Let the poll loop drop back to the short interval right away.
+            _WAKE.set()
+
+    global _REALTIME_LOOP
+    stop = asyncio.Event()
+    _REALTIME_LOOP = (asyncio.get_running_loop(), stop)
+
+    # Filter server-side so other users' inserts are never pushed to this agent.
+    row_filter = f"user_id=eq.{AGENT_USER_ID}" if AGENT_USER_ID else None
+    channel = client.channel("commands")
+    try:
+        await channel.on_postgres_changes(
+            "INSERT", schema="public", table="commands", filter=row_filter, callback=on_insert
+        ).subscribe(on_state)
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=_REALTIME_HEALTH_SEC)
+            except asyncio.TimeoutError:
+                if not _realtime_alive(client):
+                    raise ConnectionError("realtime socket closed")
+    finally:
+        _REALTIME_LOOP = None
+        _REALTIME_READY.clear()
+        # Let the poll loop drop back to the short interval until the listener restarts.
+        _WAKE.set()
+        # Leave the channel explicitly so the server doesn't keep a stale subscription around.
+        try:
+            await channel.unsubscribe()
+            await client.close()
+        except Exception as e:
+            logger.debug("Realtime cleanup failed: %s", e)
+
+
+def _realtime_thread() -> None:
+    while not _REALTIME_STOP.is_set():
+        try:
+            asyncio.run(_realtime_main())
+        except Exception as e:
+            logger.warning("Realtime listener stopped (%s); relying on REST polling", e)
+        _REALTIME_READY.clear()
+        _REALTIME_STOP.wait(POLL_WATCHDOG_SEC)
+
+
+def stop_realtime_listener(timeout_sec: float = 5.0) -> None:
+    """
+    Unsubscribe the realtime channel and stop the listener thread (best-effort).
+    """
+    _REALTIME_STOP.set()
+    running = _REALTIME_LOOP
+    if not running:
+        return
+    loop, stop = running
+    try:
+        loop.call_soon_threadsafe(stop.set)
+    except RuntimeError:
+        # Loop already closed.
+        return
+    deadline = time.monotonic() + timeout_sec
+    while _REALTIME_LOOP is not None and time.monotonic() < deadline:
+        time.sleep(0.05)
 
 
 def start_realtime_listener() -> None:
-    # supabase-py realtime channels are async-only. The sync client raises:
-    # NotImplementedError: "available in the sync client ... async client only"
-    #
-    # For MVP reliability on Windows, we poll pending commands instead.
+    # supabase-py's sync client can't do realtime, so run the async realtime client
+    # on its own event loop thread and hand rows to the main thread via a queue.
+    if not REALTIME_ENABLED:
+        logger.info("Realtime listener disabled. Polling pending commands every %.2fs", POLL_INTERVAL_SEC)
+        return
+    _REALTIME_STOP.clear()
+    threading.Thread(target=_realtime_thread, name="realtime", daemon=True).start()
     logger.info(
-        "Realtime listener disabled (sync client). Polling pending commands every %.2fs",
+        "Realtime listener starting. Polling every %.2fs until subscribed, then every %.2fs as a watchdog",
         POLL_INTERVAL_SEC,
+        POLL_WATCHDOG_SEC,
     )
 
 
+_PG_NOTIFY_READY = threading.Event()
+
+
+def _pg_listen_thread() -> None:
+    import psycopg  # type: ignore
+
+    while not _STOP.is_set():
+        try:
+            with psycopg.connect(SUPABASE_DB_URL, autocommit=True) as conn:
+                conn.execute("LISTEN commands_new")
+                _PG_NOTIFY_READY.set()
+                logger.info("Listening for commands_new notifications")
+                while not _STOP.is_set():
+                    # Returns after the timeout so _STOP is re-checked; the notify payload is the user id.
+                    for notify in conn.notifies(timeout=POLL_WATCHDOG_SEC):
+                        if not AGENT_USER_ID or notify.payload == AGENT_USER_ID:
+                            _request_repoll()
+        except Exception as e:
+            logger.warning("Postgres LISTEN stopped (%s); relying on REST polling", e)
+        finally:
+            _PG_NOTIFY_READY.clear()
+            _WAKE.set()
+        _STOP.wait(POLL_WATCHDOG_SEC)
+
+
+def start_pg_notify_listener() -> None:
+    if not SUPABASE_DB_URL:
+        return
+    try:
+        import psycopg  # type: ignore  # noqa: F401
+    except ImportError:
+        logger.warning("SUPABASE_DB_URL is set but psycopg is not installed; LISTEN/NOTIFY disabled")
+        return
+    threading.Thread(target=_pg_listen_thread, name="pg-listen", daemon=True).start()
+
+
+def _push_ready() -> bool:
+    # Some push channel (realtime or LISTEN/NOTIFY) will wake us for new rows.
+    return _REALTIME_READY.is_set() or _PG_NOTIFY_READY.is_set()
+
+
+def _request_repoll() -> None:
+    _REPOLL.set()
+    _WAKE.set()
+
+
+def _repoll_when_done(futures: set) -> None:
+    # Kick the next REST poll as soon as a full batch has drained the workers.
+    def _watch() -> None:
+        wait(futures)
+        _request_repoll()
+
+    threading.Thread(target=_watch, name="repoll", daemon=True).start()
+
+
+def request_stop() -> None:
+    _STOP.set()
+    _WAKE.set()
+    try:
+        _STOP_FUTURE.set_result(None)
+    except InvalidStateError:
+        pass
+
+
+def _wait_for_realtime_rows(interval_sec: float) -> None:
+    """
+    Handle realtime-pushed rows until the next REST poll is due, a re-poll is requested
+    or the agent stops. Returns early if the push channels drop, so polling falls back to
+    the short interval.
+    """
+    was_ready = _push_ready()
+    deadline = time.monotonic() + interval_sec
+    while not _STOP.is_set():
+        while True:
+            try:
+                row = _REALTIME_ROWS.get_nowait()
+            except queue.Empty:
+                break
+            cmd = _unpack_row(row)
+            if not cmd:
+                continue
+            if _CLAIM_BATCH_RPC_AVAILABLE:
+                # Let claim_pending_commands claim it: an unclaimed submit here would sit in
+                # _INFLIGHT and drop the poll's claimed copy of the same row, then fail its own
+                # claim_command and leave the row stuck in "processing".
+                _request_repoll()
+            else:
+                # SELECT fallback: both paths claim row by row, so run it now without waiting.
+                _submit_command(cmd)
+        if _REPOLL.is_set():
+            _REPOLL.clear()
+            return
+        if was_ready and not _push_ready():
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        _WAKE.wait(remaining)
+        # Cleared before re-checking the queue/flags above, so a set() is never lost.
+        _WAKE.clear()
+
+
 def poll_pending_commands_forever() -> None:
-    while True:
+    empty_polls = 0
+    avg_rows = POLL_MAX_BATCH / 2
+    last_error_log = 0.0
+    suppressed_errors = 0
+    while not _STOP.is_set():
+        rows = []
+        submitted = 0
+        running: set = set()
+        batch = _next_batch_size(avg_rows)
         try:
-            query = (
-                supabase.table("commands")
-                .select("id,user_id,command_text,status")
-                .eq("status", "pending")
-                .order("created_at", desc=False)
-                .limit(POLL_MAX_BATCH)
-            )
+            rows, claimed = _fetch_pending_commands(batch)
+            with _batched_updates() as batch_updates:
+                submitted, running = _dispatch_rows(rows, POLL_INTERVAL_SEC * 10, claimed, batch_updates)
+        except Exception as e:
+            # One traceback per 5s at most, so an outage doesn't flood the log every tick.
+            now = time.monotonic()
+            if now - last_error_log >= 5.0:
+                logger.exception("Polling loop error (%d similar suppressed)", suppressed_errors)
+                last_error_log = now
+                suppressed_errors = 0
+            else:
+                suppressed_errors += 1
+                logger.debug("Polling loop error: %s", e)
+
+        avg_rows = 0.9 * avg_rows + 0.1 * len(rows)
+        # A full batch means more rows are likely queued: grow the next batch (x2) and poll
+        # again right away, or as soon as long-running commands from it have freed the workers.
+        # Only if it started new work, though: a SELECT-fallback batch of rows that are already
+        # queued (realtime submitted them) would otherwise re-poll in a tight loop.
+        if len(rows) >= batch and submitted:
+            avg_rows = max(avg_rows, float(batch))
+            empty_polls = 0
+            if not running:
+                continue
+            _repoll_when_done(running)
+
+        if _push_ready():
+            interval = POLL_WATCHDOG_SEC
+        elif rows:
+            empty_polls = 0
+            interval = POLL_INTERVAL_SEC
+        else:
+            interval = min(POLL_INTERVAL_SEC * (2**empty_polls), max(POLL_INTERVAL_SEC, POLL_MAX_SLEEP_SEC))
+            # Jitter idle polls so agents started together (e.g. after an outage) don't poll in lockstep.
+            if empty_polls:
+                interval += random.uniform(0, 0.25)
+            empty_polls = min(empty_polls + 1, 16)
+        _wait_for_realtime_rows(interval)
 
-            if AGENT_USER_ID:
-                query = query.eq("user_id", AGENT_USER_ID)
 
-            response = query.execute()
-            rows = response.data or []
-            for row in rows:
-                handle_command(row)
-        except Exception:
-            logger.exception("Polling loop error")
+def _write_pid_file() -> None:
+    try:
+        _PID_PATH.write_text(str(os.getpid()), encoding="ascii")
+    except OSError as e:
+        logger.debug("Could not write %s: %s", _PID_PATH, e)
+
 
-        time.sleep(POLL_INTERVAL_SEC)
+def _remove_pid_file() -> None:
+    try:
+        if _PID_PATH.read_text(encoding="ascii").strip() == str(os.getpid()):
+            _PID_PATH.unlink()
+    except OSError:
+        pass
 
 
 def main() -> None:
-    bootstrap_pending_commands()
+    _acquire_single_instance_guard()
+    _write_pid_file()
+    _supabase_client()
+    # SIGTERM (service stop / kill) exits the poll loop within milliseconds.
+    signal.signal(signal.SIGTERM, lambda *_: request_stop())
+    _prewarm_gui_modules()
+    recover_orphaned_commands()
     start_realtime_listener()
-    poll_pending_commands_forever()
+    start_pg_notify_listener()
+    try:
+        poll_pending_commands_forever()
+    finally:
+        request_stop()
+        stop_realtime_listener()
+        _release_queued_commands()
+        _remove_pid_file()
 
 
 if __name__ == "__main__":
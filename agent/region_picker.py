@@ -7,8 +7,12 @@ from dataclasses import dataclass
 from typing import Dict, Optional, Tuple
 
 
-@dataclass
+# Frozen + __slots__: a new Rect is built on every drag step, so keep instances small.
+# (Explicit __slots__ rather than dataclass(slots=True), which needs Python 3.10.)
+@dataclass(frozen=True)
 class Rect:
+    __slots__ = ("left", "top", "width", "height")
+
     left: int
     top: int
     width: int
@@ -19,6 +23,9 @@ class Rect:
         h = max(40, self.height)
         l = max(0, min(self.left, screen_w - w))
         t = max(0, min(self.top, screen_h - h))
+        # Rect is immutable, so an already in-bounds rect can be returned as-is.
+        if (l, t, w, h) == (self.left, self.top, self.width, self.height):
+            return self
         return Rect(l, t, w, h)
 
     def to_env(self) -> str:
@@ -26,6 +33,8 @@ class Rect:
 
 
 class RegionPicker(tk.Tk):
+    _CORNER_NAMES = ("nw", "ne", "sw", "se")
+
     def __init__(self, title: str, color: str) -> None:
         super().__init__()
 
@@ -59,14 +68,19 @@ class RegionPicker(tk.Tk):
 
         self.color = color
         self.handle_size = 10
+        # Corner grab tolerance: a little larger than the drawn handle.
+        self._hit_hs = self.handle_size + 4
 
         self._drag_mode: Optional[str] = None
         self._drag_corner: Optional[str] = None
         self._start_mouse: Tuple[int, int] = (0, 0)
+        self._last_xy: Tuple[int, int] = (0, 0)
         self._start_rect: Rect = self.rect
 
         self.result: Optional[Rect] = None
+        self._redraw_pending = False
 
+        self._create_items()
         self._draw()
 
         self.canvas.bind("<ButtonPress-1>", self._on_down)
@@ -90,45 +104,36 @@ class RegionPicker(tk.Tk):
         y = max(0, self.rect.top - 42)
         return (x, y, x + 220, y + 36)
 
-    def _draw(self) -> None:
-        self.canvas.delete("all")
-        r = self.rect.clamp(self.screen_w, self.screen_h)
-        self.rect = r
+    def _corners(self) -> Tuple[Tuple[int, int], ...]:
+        # Same order as _CORNER_NAMES.
+        l, t, w, h = self.rect.left, self.rect.top, self.rect.width, self.rect.height
+        return ((l, t), (l + w, t), (l, t + h), (l + w, t + h))
 
-        l, t, w, h = r.left, r.top, r.width, r.height
-        self.canvas.create_rectangle(
-            l,
-            t,
-            l + w,
-            t + h,
-            outline=self.color,
-            width=4,
-            tags=("rect",),
-        )
+    def _create_items(self) -> None:
+        """
+        Create every canvas item once. `_draw` only moves them, so a drag doesn't rebuild the overlay.
+        """
+        c = self.canvas
+        self._rect_id = c.create_rectangle(0, 0, 0, 0, outline=self.color, width=4, tags=("rect",))
 
         # handles (corners)
-        hs = self.handle_size
-        corners = {
-            "nw": (l, t),
-            "ne": (l + w, t),
-            "sw": (l, t + h),
-            "se": (l + w, t + h),
-        }
-        for name, (cx, cy) in corners.items():
-            self.canvas.create_rectangle(
-                cx - hs,
-                cy - hs,
-                cx + hs,
-                cy + hs,
+        self._handle_ids = tuple(
+            c.create_rectangle(
+                0,
+                0,
+                0,
+                0,
                 fill=self.color,
                 outline="white",
                 width=1,
                 tags=(f"handle:{name}", "handle"),
             )
+            for name in self._CORNER_NAMES
+        )
 
-        # toolbar
-        tx1, ty1, tx2, ty2 = self._toolbar_bbox()
-        self.canvas.create_rectangle(
+        # toolbar: laid out at (0, 0) and moved as one group (tag "toolbar_group")
+        tx1, ty1, tx2, ty2 = 0, 0, 220, 36
+        c.create_rectangle(
             tx1,
             ty1,
             tx2,
@@ -136,23 +141,26 @@ class RegionPicker(tk.Tk):
             fill="#111827",
             outline=self.color,
             width=2,
-            tags=("toolbar",),
+            tags=("toolbar", "toolbar_group"),
         )
-        self.canvas.create_text(
+        c.create_text(
             tx1 + 10,
             ty1 + 18,
             anchor="w",
             fill="white",
             font=("Segoe UI", 10, "bold"),
             text="Drag / resize, then OK",
-            tags=("toolbar",),
+            tags=("toolbar", "toolbar_group"),
         )
 
-        # buttons
+        # buttons; bboxes are kept (relative to the toolbar origin) for a pure-Python hit test
+        self._btn_bboxes: list[Tuple[int, int, int, int, str]] = []
+
         def btn(x: int, label: str, tag: str) -> None:
             bw, bh = 52, 22
             y = ty1 + 7
-            self.canvas.create_rectangle(
+            self._btn_bboxes.append((x - tx1, y - ty1, x - tx1 + bw, y - ty1 + bh, tag))
+            c.create_rectangle(
                 x,
                 y,
                 x + bw,
@@ -160,44 +168,59 @@ class RegionPicker(tk.Tk):
                 fill="#0f172a",
                 outline="white",
                 width=1,
-                tags=("btn", tag),
+                tags=("btn", tag, "toolbar_group"),
             )
-            self.canvas.create_text(
+            c.create_text(
                 x + bw // 2,
                 y + bh // 2,
                 fill="white",
                 font=("Segoe UI", 9, "bold"),
                 text=label,
-                tags=("btn", tag),
+                tags=("btn", tag, "toolbar_group"),
             )
 
         btn(tx2 - 58, "OK", "btn:ok")
         btn(tx2 - 116, "Reset", "btn:reset")
         btn(tx2 - 174, "Cancel", "btn:cancel")
 
+        self._toolbar_origin: Tuple[int, int] = (tx1, ty1)
+        self._drawn_rect: Optional[Rect] = None
+
+    def _draw(self) -> None:
+        r = self.rect.clamp(self.screen_w, self.screen_h)
+        self.rect = r
+        # Motion events often repeat the same (clamped) rect; skip the canvas work then.
+        if r == self._drawn_rect:
+            return
+        self._drawn_rect = r
+
+        l, t, w, h = r.left, r.top, r.width, r.height
+        self.canvas.coords(self._rect_id, l, t, l + w, t + h)
+
+        hs = self.handle_size
+        for handle_id, (cx, cy) in zip(self._handle_ids, self._corners()):
+            self.canvas.coords(handle_id, cx - hs, cy - hs, cx + hs, cy + hs)
+
+        tx1, ty1, _tx2, _ty2 = self._toolbar_bbox()
+        ox, oy = self._toolbar_origin
+        if (tx1, ty1) != (ox, oy):
+            self.canvas.move("toolbar_group", tx1 - ox, ty1 - oy)
+            self._toolbar_origin = (tx1, ty1)
+
     def _hit_test(self, x: int, y: int) -> Tuple[Optional[str], Optional[str]]:
         # returns (mode, corner) where mode in {"move","resize","button"}
         l, t, w, h = self.rect.left, self.rect.top, self.rect.width, self.rect.height
-        hs = self.handle_size + 4
-        corners = {
-            "nw": (l, t),
-            "ne": (l + w, t),
-            "sw": (l, t + h),
-            "se": (l + w, t + h),
-        }
-        for name, (cx, cy) in corners.items():
+        hs = self._hit_hs
+        for name, (cx, cy) in zip(self._CORNER_NAMES, self._corners()):
             if abs(x - cx) <= hs and abs(y - cy) <= hs:
                 return ("resize", name)
 
         tx1, ty1, tx2, ty2 = self._toolbar_bbox()
         if tx1 <= x <= tx2 and ty1 <= y <= ty2:
-            # check button tags using canvas hit
-            items = self.canvas.find_overlapping(x, y, x, y)
-            for it in items:
-                tags = self.canvas.gettags(it)
-                for tag in tags:
-                    if tag.startswith("btn:"):
-                        return ("button", tag)
+            rx, ry = x - tx1, y - ty1
+            for bx1, by1, bx2, by2, tag in self._btn_bboxes:
+                if bx1 <= rx <= bx2 and by1 <= ry <= by2:
+                    return ("button", tag)
             return ("button", None)
 
         if l <= x <= l + w and t <= y <= t + h:
@@ -219,12 +242,17 @@ class RegionPicker(tk.Tk):
         self._drag_mode = mode
         self._drag_corner = corner
         self._start_mouse = (int(e.x), int(e.y))
+        self._last_xy = self._start_mouse
         self._start_rect = self.rect
 
     def _on_move(self, e: tk.Event) -> None:
         if not self._drag_mode:
             return
         x, y = int(e.x), int(e.y)
+        # Tk coordinates are integers; skip repeated motion events at the same pixel.
+        if (x, y) == self._last_xy:
+            return
+        self._last_xy = (x, y)
         sx, sy = self._start_mouse
         dx, dy = x - sx, y - sy
 
@@ -241,7 +269,20 @@ class RegionPicker(tk.Tk):
                 self.rect = Rect(l, t + dy, w + dx, h - dy)
             elif self._drag_corner == "nw":
                 self.rect = Rect(l + dx, t + dy, w - dx, h - dy)
+        self._schedule_draw()
+
+    def _schedule_draw(self) -> None:
+        # Motion events can arrive faster than Tk repaints; draw at most once per idle cycle.
+        if not self._redraw_pending:
+            self._redraw_pending = True
+            self.after_idle(self._flush_draw)
+
+    def _flush_draw(self) -> None:
+        self._redraw_pending = False
         self._draw()
+        # Paint the moved items now, in one pass, before more motion events are dispatched.
+        # (update_idletasks, not update: no re-entry into the event loop.)
+        self.canvas.update_idletasks()
 
     def _on_up(self, _e: tk.Event) -> None:
         self._drag_mode = None
@@ -3,24 +3,25 @@
 $root = Split-Path -Parent $PSScriptRoot
 Set-Location (Join-Path $root "agent")
 
-# Prevent accidental double-runs: use the agent's singleton lock port (default 45321).
-$lockPort = 45321
+# Prevent accidental double-runs: the agent holds a named mutex (Global\<AGENT_LOCK_NAME>, default ServerVibeAgent).
+$lockName = "ServerVibeAgent"
 $envPath = Join-Path (Get-Location) ".env"
 if (Test-Path $envPath) {
-  $line = Get-Content $envPath -ErrorAction SilentlyContinue | Where-Object { $_ -match '^AGENT_LOCK_PORT=' } | Select-Object -First 1
+  $line = Get-Content $envPath -ErrorAction SilentlyContinue | Where-Object { $_ -match '^AGENT_LOCK_NAME=' } | Select-Object -First 1
   if ($line) {
     $v = ($line -split '=', 2)[1].Trim()
-    if ($v -match '^\d+$') { $lockPort = [int]$v }
+    if ($v) { $lockName = $v }
   }
 }
 try {
-  $listener = Get-NetTCPConnection -State Listen -LocalPort $lockPort -ErrorAction SilentlyContinue
-  if ($listener) {
-    Write-Host "Agent already running (lock port $lockPort is listening). Stop it (Ctrl+C) before starting again." -ForegroundColor Yellow
+  $existing = $null
+  if ([System.Threading.Mutex]::TryOpenExisting("Global\$lockName", [ref]$existing)) {
+    $existing.Dispose()
+    Write-Host "Agent already running (mutex Global\$lockName is held). Stop it (Ctrl+C) before starting again." -ForegroundColor Yellow
     exit 0
   }
 } catch {
-  # Ignore; some environments may not have Get-NetTCPConnection.
+  # Ignore; access-denied etc. means we can't tell, and the agent re-checks on startup anyway.
 }
 
 function Resolve-PythonPath {
@@ -1,39 +1,34 @@
 $ErrorActionPreference = "Stop"
 
 $root = Split-Path -Parent $PSScriptRoot
+$pidPath = Join-Path $root "agent\agent.pid"
 
-# Prefer the agent's singleton lock port (default 45321) to identify the main process.
-$lockPort = 45321
-$envPath = Join-Path (Join-Path $root "agent") ".env"
-if (Test-Path $envPath) {
-  $line = Get-Content $envPath -ErrorAction SilentlyContinue | Where-Object { $_ -match '^AGENT_LOCK_PORT=' } | Select-Object -First 1
-  if ($line) {
-    $v = ($line -split '=', 2)[1].Trim()
-    if ($v -match '^\d+$') { $lockPort = [int]$v }
+# The agent's singleton guard is a named mutex (no lock port). It writes agent\agent.pid while
+# running; the venv's python.exe is only a launcher, so that PID is the real interpreter.
+$candidates = @()
+if (Test-Path $pidPath) {
+  $filePid = Get-Content $pidPath -ErrorAction SilentlyContinue | Select-Object -First 1
+  if ($filePid -match '^\s*\d+\s*$') {
+    # A stale file (agent killed) may name a reused PID; only trust a python main.py process.
+    $proc = Get-CimInstance Win32_Process -Filter "ProcessId = $([int]$filePid)" -ErrorAction SilentlyContinue
+    if ($proc -and $proc.Name -like "python*" -and $proc.CommandLine -match "main\.py") {
+      $candidates += [pscustomobject]@{ ProcessId = [int]$filePid }
+    }
   }
 }
 
-$mainPid = $null
-try {
-  $listener = Get-NetTCPConnection -State Listen -LocalPort $lockPort -ErrorAction SilentlyContinue | Select-Object -First 1
-  if ($listener) { $mainPid = $listener.OwningProcess }
-} catch {
-  # Ignore environments without Get-NetTCPConnection.
-}
-
-# Best-effort: stop the main PID (lock port owner) plus any other python main.py processes under ServerVibe/agent.
-$candidates = @()
-if ($mainPid) {
-  $candidates += [pscustomobject]@{ ProcessId = $mainPid }
-}
+# Fallback (agent killed before writing the file, or an older agent): python main.py processes
+# started from this checkout, e.g. <root>\agent\.venv\Scripts\python.exe main.py.
+$rootPattern = [regex]::Escape($root)
 $candidates += Get-CimInstance Win32_Process -ErrorAction SilentlyContinue | Where-Object {
-  $_.Name -eq "python.exe" -and $_.CommandLine -match "ServerVibe" -and $_.CommandLine -match "main\\.py"
+  $_.Name -eq "python.exe" -and $_.CommandLine -match $rootPattern -and $_.CommandLine -match "main\.py"
 } | Select-Object -ExpandProperty ProcessId | ForEach-Object { [pscustomobject]@{ ProcessId = $_ } }
 
 $candidates = $candidates | Select-Object -Unique ProcessId
 
 if (-not $candidates) {
   Write-Host "No running agent process found." -ForegroundColor Yellow
+  Remove-Item $pidPath -ErrorAction SilentlyContinue
   exit 0
 }
 
@@ -47,3 +42,6 @@ foreach ($procId in $pids) {
     Write-Host ("Failed to stop PID " + $procId + ": " + $_.Exception.Message) -ForegroundColor Red
   }
 }
+
+# Stop-Process -Force skips the agent's own cleanup.
+Remove-Item $pidPath -ErrorAction SilentlyContinue
@@ -13,9 +13,16 @@ create table if not exists public.commands (
     check (status in ('pending','processing','completed','error')),
   response_log text,
   image_url text,
-  created_at timestamptz not null default now()
+  created_at timestamptz not null default now(),
+  -- Set by the claim RPCs: when and by which agent (AGENT_ID) the row went to 'processing'.
+  claimed_at timestamptz,
+  claimed_by text
 );
 
+-- Upgrading an existing table from an earlier version of this script:
+alter table public.commands add column if not exists claimed_at timestamptz;
+alter table public.commands add column if not exists claimed_by text;
+
 -- 2) Helpful indexes
 create index if not exists idx_commands_user_created_at
   on public.commands (user_id, created_at desc);
@@ -113,7 +120,100 @@ create policy if not exists "Users can delete own screenshots"
     and (storage.foldername(name))[1] = auth.uid()::text
   );
 
--- 8) Optional trigger to keep updated_at (if you add the column later)
+-- 8) Agent RPCs: atomic claim (pending -> processing) in one round-trip.
+-- Returns the claimed row, or no rows if another agent already took it.
+-- p_agent is the claiming agent's AGENT_ID, recorded for orphan recovery.
+-- (Drops the pre-claimed_by signature so PostgREST calls stay unambiguous.)
+drop function if exists public.claim_command(uuid);
+create or replace function public.claim_command(cmd_id uuid, p_agent text)
+returns setof public.commands
+language sql
+as $$
+  update public.commands
+     set status = 'processing',
+         response_log = 'Command received',
+         claimed_at = now(),
+         claimed_by = p_agent
+   where id = cmd_id
+     and status = 'pending'
+  returning *;
+$$;
+
+-- Only the agent (service_role) should call this.
+revoke execute on function public.claim_command(uuid, text) from public, anon, authenticated;
+
+-- Batch claim for the poller: claims up to p_batch pending rows (oldest first) and returns them.
+-- SKIP LOCKED lets several agents poll concurrently without ever claiming the same row.
+-- p_user = null claims rows for every user.
+drop function if exists public.claim_pending_commands(uuid, integer);
+create or replace function public.claim_pending_commands(p_user uuid, p_batch integer, p_agent text)
+returns setof public.commands
+language sql
+as $$
+  update public.commands c
+     set status = 'processing',
+         response_log = 'Command received',
+         claimed_at = now(),
+         claimed_by = p_agent
+   where c.id in (
+     select id
+       from public.commands
+      where status = 'pending'
+        and (p_user is null or user_id = p_user)
+      order by created_at
+      limit p_batch
+      for update skip locked
+   )
+  returning c.*;
+$$;
+
+revoke execute on function public.claim_pending_commands(uuid, integer, text) from public, anon, authenticated;
+
+-- Startup recovery: rows this agent (p_agent) left in 'processing' were orphaned when it crashed
+-- or was killed mid-command; it holds the single-instance lock and hasn't claimed anything yet,
+-- so all of them are. Rows other agents claimed are left alone, however long they run. Rows
+-- claimed before claimed_by existed fall back to age since claim (or creation).
+-- Orphans are marked as errors (re-running them may not be safe).
+drop function if exists public.fail_orphaned_commands(uuid, integer);
+create or replace function public.fail_orphaned_commands(p_user uuid, p_agent text, p_stale_seconds integer)
+returns setof public.commands
+language sql
+as $$
+  update public.commands
+     set status = 'error',
+         response_log = coalesce(response_log || E'\n\n', '') || '[agent restarted while processing]'
+   where status = 'processing'
+     and (p_user is null or user_id = p_user)
+     and (
+       claimed_by = p_agent
+       or (
+         claimed_by is null
+         and coalesce(claimed_at, created_at) < now() - make_interval(secs => p_stale_seconds)
+       )
+     )
+  returning *;
+$$;
+
+revoke execute on function public.fail_orphaned_commands(uuid, text, integer) from public, anon, authenticated;
+
+-- Optional: NOTIFY on insert, for agents configured with SUPABASE_DB_URL (LISTEN commands_new).
+-- The payload is the owner's user id so each agent only wakes for its own commands.
+create or replace function public.notify_command_insert()
+returns trigger
+language plpgsql
+as $$
+begin
+  perform pg_notify('commands_new', new.user_id::text);
+  return new;
+end;
+$$;
+
+drop trigger if exists trg_commands_notify on public.commands;
+create trigger trg_commands_notify
+after insert on public.commands
+for each row execute function public.notify_command_insert();
+
+-- 9) Optional trigger to keep updated_at (if you add the column later)
 -- alter table public.commands add column if not exists updated_at timestamptz not null default now();
 -- create or replace function public.set_updated_at()
 -- returns trigger as $$